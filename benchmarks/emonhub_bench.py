@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+  emonHub benchmarks
+
+  Times frame parsing and decoding, the buffers, the encoding of the posts
+  and the whole pipeline from an interfacer to a local HTTP server:
+
+      python benchmarks/emonhub_bench.py --output results.json
+
+  and compares the results against a saved run:
+
+      python benchmarks/emonhub_bench.py --baseline results.json --threshold 10
+
+  which exits with status 1 if a result is more than 10% slower.
+
+  Every result is a rate (items per second, higher is better), the best of
+  --repeat runs on the same generated data.
+
+"""
+
+import os
+import sys
+import gc
+import time
+import json
+import random
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import emonhub_coder as ehc
+import emonhub_buffer as ehb
+import emonhub_interfacer as ehi
+import emonhub_reporter as ehr
+import emonhub_loop as ehl
+
+# Frame layouts: interfacer datacode, nodes settings and node 5's values
+# (raw bytes for the decoded layouts)
+layouts = {
+    'plain': ('0', {}, [230, 1500, 240, 17]),
+    'datacode_h': ('h', {}, [230, 0, 220, 5, 240, 0, 17, 0]),
+    'datacodes_hhL': ('0', {'5': {'datacodes': ['h', 'h', 'L']}}, [230, 0, 220, 5, 240, 0, 17, 0]),
+    'datacodes_ffff': ('0', {'5': {'datacodes': ['f', 'f', 'f', 'f']}},
+                       [0, 0, 102, 67, 0, 128, 187, 68, 0, 0, 112, 67, 0, 0, 136, 65]),
+    # emonTx V3: power1-4, Vrms, temp1-6 and pulse count (12 values, 26 bytes)
+    'datacodes_emontx': ('0', {'5': {'datacodes': ['h'] * 11 + ['L']}},
+                         [220, 5, 100, 0, 0, 0, 17, 0, 142, 93, 236, 0, 232, 3, 232, 3,
+                          232, 3, 232, 3, 232, 3, 57, 48, 0, 0]),
+}
+
+# Buffer sizes, the largest ones are skipped with --quick
+buffer_sizes = [1000, 10000, 100000, 1000000]
+
+
+def best_rate(func, items, repeat):
+    """Return the best rate of items/s of repeat calls to func()
+
+    func is called once beforehand to warm up caches, the garbage collector
+    is disabled while timing, as timeit does.
+
+    """
+
+    func()
+    best = None
+    for i in xrange(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.time()
+            func()
+            elapsed = time.time() - started
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return items / max(best, 1e-9)
+
+
+def make_lines(layout, n, seed=0):
+    """Return n frames of a layout as received by an interfacer"""
+
+    rnd = random.Random(seed)
+    values = layouts[layout][2]
+    lines = []
+    for i in xrange(n):
+        # Vary the first byte so that frames differ, staying a valid byte
+        frame = [5, rnd.randint(0, 255)] + values[1:]
+        lines.append((' '.join(str(v) for v in frame), 1500000000 + i))
+    return lines
+
+
+def make_items(n, seed=0):
+    """Return n buffer items: [timestamp, node, values...]"""
+
+    rnd = random.Random(seed)
+    return [[1500000000 + i * 10, 10, rnd.randint(0, 3000), rnd.randint(0, 3000),
+             round(rnd.uniform(200, 250), 1), rnd.randint(0, 50)] for i in xrange(n)]
+
+
+def bench_parse(repeat, quick):
+    """Frame validation, decoding and conversion by _process_frames()"""
+
+    results = {}
+    n = 2000
+    for layout, (datacode, nodes, values) in sorted(layouts.items()):
+        ehc.set_nodelist(nodes)
+        interfacer = ehi.EmonHubInterfacer('bench')
+        interfacer.set(datacode=datacode)
+        lines = make_lines(layout, n)
+        for batch in [1, 100]:
+            def run():
+                for i in xrange(0, n, batch):
+                    interfacer._process_frames(lines[i:i + batch])
+            results['parse.%s.batch%d' % (layout, batch)] = (best_rate(run, n, repeat), 'frames/s')
+    ehc.set_nodelist({})
+    return results
+
+
+def bench_decode(repeat, quick):
+    """ehc.decode() per value and ehc.decode_batch() per payload"""
+
+    results = {}
+    n = 2000
+    for code, size in [('h', 2), ('L', 4), ('f', 4)]:
+        payloads = [[random.Random(i).randint(0, 255) for j in xrange(size)] for i in xrange(n)]
+
+        def run():
+            for payload in payloads:
+                ehc.decode(code, payload)
+        results['decode.value_%s' % code] = (best_rate(run, n, repeat), 'values/s')
+
+    for layout in ['datacodes_hhL', 'datacodes_ffff', 'datacodes_emontx']:
+        decoder = ehc.compile_datacodes(layouts[layout][1]['5']['datacodes'])
+        payloads = [[str(v) for v in line.split()[1:]] for line, t in make_lines(layout, n)]
+        for batch in [1, 100]:
+            def run():
+                for i in xrange(0, n, batch):
+                    ehc.decode_batch(decoder, payloads[i:i + batch])
+            results['decode.batch_%s.batch%d' % (layout.split('_')[1], batch)] = \
+                (best_rate(run, n, repeat), 'payloads/s')
+    return results
+
+
+def bench_buffer(repeat, quick):
+    """Storing, retrieving and discarding items by batches of 100"""
+
+    results = {}
+    path = tempfile.mkdtemp(prefix='emonhub_bench')
+    try:
+        for size in buffer_sizes[:3 if quick else 4]:
+            items = make_items(size)
+            for buffer_type, kwargs in [('memory', {}), ('compressed', {}),
+                                        ('disk', {'buffer_path': path, 'sync_interval': 1})]:
+                # Few runs of the largest sizes, they take seconds each
+                runs = max(1, repeat * 10000 / size)
+                state = {}
+
+                def store():
+                    if 'buffer' in state:
+                        state['buffer'].close()
+                        shutil.rmtree(os.path.join(path, 'bench'), True)
+                    buf = state['buffer'] = ehb.getBuffer(buffer_type)('bench', size, **kwargs)
+                    for i in xrange(0, size, 100):
+                        buf.storeItems(items[i:i + 100])
+                results['buffer.%s.store.%d' % (buffer_type, size)] = \
+                    (best_rate(store, size, runs), 'items/s')
+
+                def drain():
+                    buf = state['buffer']
+                    while buf.hasItems():
+                        buf.retrieveItems(100)
+                        buf.discardLastRetrievedItems(100)
+
+                def refill_drain():
+                    store()
+                    started = time.time()
+                    drain()
+                    return time.time() - started
+
+                # Draining empties the buffer, so it is refilled before each run
+                best = min(refill_drain() for i in xrange(runs))
+                results['buffer.%s.retrieve_discard.%d' % (buffer_type, size)] = \
+                    (size / max(best, 1e-9), 'items/s')
+                state['buffer'].close()
+                shutil.rmtree(os.path.join(path, 'bench'), True)
+    finally:
+        shutil.rmtree(path, True)
+    return results
+
+
+def bench_encode(repeat, quick):
+    """Encoding of the emoncms bulk posts"""
+
+    results = {}
+    ring = ehb.FanoutRing()
+    reporter = ehr.EmonHubEmoncmsReporter('bench', ring.cursor('bench'))
+    for batch in [100, 1000]:
+        items = make_items(batch)
+        for encoding, settings in [('json', {}), ('compact', {'compact': 'on'}),
+                                   ('gzip', {'gzip': 'on'}), ('compact_gzip', {'compact': 'on', 'gzip': 'on'})]:
+            reporter.set(apikey='a' * 32, **settings)
+
+            def run():
+                for i in xrange(10):
+                    reporter._encode_post(items)
+            rate = best_rate(run, 10 * batch, repeat)
+            size = len(reporter._encode_post(items)[1])
+            results['encode.%s.batch%d' % (encoding, batch)] = (rate, 'items/s')
+            results['encode.%s.batch%d.density' % (encoding, batch)] = \
+                (batch * 1024.0 / size, 'items/kB')
+    ring.remove_cursor('bench')
+    return results
+
+"""class BenchInterfacer
+
+Interfacer reading pre-generated frames, as fast as they are asked for
+
+"""
+
+
+class BenchInterfacer(ehi.EmonHubInterfacer):
+
+    def __init__(self, name, lines, batch):
+        super(BenchInterfacer, self).__init__(name)
+        self._lines = lines
+        self._batch = batch
+        self._pos = 0
+
+    def read_batch(self):
+        lines = self._lines[self._pos:self._pos + self._batch]
+        self._pos += len(lines)
+        return self._process_frames(lines)
+
+
+class _SinkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Counts the rows posted, replies 'ok'"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        rows = json.loads(urlparse.parse_qs(body)['data'][0])
+        with self.server.lock:
+            self.server.rows += len(rows)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class _Sink(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+def bench_pipeline(repeat, quick):
+    """Frames from an interfacer to a local HTTP server, through the queue and a reporter"""
+
+    results = {}
+    n = 20000 if quick else 50000
+    lines = make_lines('datacodes_hhL', n)
+    ehc.set_nodelist(layouts['datacodes_hhL'][1])
+    sink = _Sink(('127.0.0.1', 0), _SinkHandler)
+    sink.lock = threading.Lock()
+    thread = threading.Thread(target=sink.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d' % sink.server_address[1]
+
+    for runtime in ['threads', 'eventloop']:
+        def run():
+            sink.rows = 0
+            ring = ehb.FanoutRing()
+            reporter = ehr.EmonHubEmoncmsReporter('bench', ring.cursor('bench'), buffer_size=n)
+            reporter.set(url=url, apikey='a' * 32, batchsize='250', pipeline='2')
+            if runtime == 'threads':
+                reporter.start()
+            interfacer = BenchInterfacer('bench', lines, 100)
+
+            def feed():
+                while True:
+                    frames = interfacer.read_batch()
+                    if not frames:
+                        break
+                    ring.put(frames)
+                    yield ehl.Wait(timeout=0)
+                while sink.rows < n:
+                    yield ehl.Wait(timeout=0.001)
+                reporter.stop = True
+                ring.remove_cursor('bench')
+
+            loop = ehl.EmonHubEventLoop()
+            if runtime == 'threads':
+                loop.run([loop.spawn(feed(), 'feed')])
+                reporter.join()
+            else:
+                task = loop.spawn(reporter.run_async(), 'bench')
+                loop.run([loop.spawn(feed(), 'feed'), task])
+        results['pipeline.%s' % runtime] = (best_rate(run, n, max(1, repeat / 2)), 'frames/s')
+
+    sink.shutdown()
+    sink.server_close()
+    ehc.set_nodelist({})
+    return results
+
+# Benchmarks by name
+benchmarks = [('parse', bench_parse), ('decode', bench_decode), ('buffer', bench_buffer),
+              ('encode', bench_encode), ('pipeline', bench_pipeline)]
+
+
+def compare(results, baseline, threshold):
+    """Print each result against the baseline
+
+    Return the names of the results more than threshold % slower.
+
+    """
+
+    regressions = []
+    for name in sorted(results):
+        value = results[name]['value']
+        if name not in baseline:
+            print '%-50s %14.1f %-12s (new)' % (name, value, results[name]['unit'])
+            continue
+        base = baseline[name]['value']
+        change = (value - base) / base * 100 if base else 0
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print '%-50s %14.1f %-12s %+7.1f%%%s' % (name, value, results[name]['unit'], change, flag)
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='emonHub benchmarks')
+    parser.add_argument('--only', action='append', choices=[name for name, func in benchmarks],
+                        help='run this benchmark only (may be repeated)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each measure, the best is kept')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes, for a quick check')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results saved in this JSON file')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percentage slower than the baseline reported as a regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    random.seed(0)
+
+    results = {}
+    for name, func in benchmarks:
+        if args.only and name not in args.only:
+            continue
+        sys.stderr.write('Running ' + name + '...\n')
+        for result, (value, unit) in func(args.repeat, args.quick).iteritems():
+            results[result] = {'value': value, 'unit': unit}
+
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'numpy': ehc.numpy is not None,
+                       'repeat': args.repeat, 'quick': args.quick},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print '%d result(s) more than %.0f%% slower than the baseline' % (len(regressions), args.threshold)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
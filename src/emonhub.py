@@ -16,12 +16,16 @@ import logging.handlers
 import signal
 import argparse
 import pprint
-import Queue
+import select
+import errno
 
 import emonhub_setup as ehs
 import emonhub_reporter as ehr
 import emonhub_interfacer as ehi
 import emonhub_coder as ehc
+import emonhub_buffer as ehb
+import emonhub_metrics as ehm
+import emonhub_loop as ehl
 
 """class EmonHub
 
@@ -60,63 +64,167 @@ class EmonHub(object):
         # Initialize Reporters and Interfacers
         self._reporters = {}
         self._interfacers = {}
-        self._queue = {}
+
+        # Instrumentation settings in use
+        self._instrumentation = ('off', 300)
+
+        # Metrics HTTP server, and its (address, port) setting
+        self._metrics_server = None
+        self._metrics_address = None
+
+        # Interfacers run in worker processes
+        self._multiprocess = False
+
+        # Initialize the queue shared by all reporters, sized from the settings
+        self._queue = ehb.FanoutRing()
+
+        # Run the reporters as threads, or everything in one event loop
+        # (read at start up only)
+        runtime = str(settings['hub'].get('runtime', 'threads')).lower()
+        if runtime not in ['threads', 'eventloop']:
+            self._log.warning("'%s' is not a valid setting for hub: runtime" % runtime)
+            runtime = 'threads'
+        self._loop = ehl.EmonHubEventLoop() if runtime == 'eventloop' else None
+        # Event loop tasks running the reporters, by name
+        self._tasks = {}
+        self._log.info("Runtime: " + runtime)
+
         self._update_settings(settings)
         
+    # Longest wait (seconds) between two reads when an interfacer can't be waited on
+    _poll_interval = 0.2
+
     def run(self):
         """Launch the hub.
         
         Monitor the COM port and process data.
         Check settings on a regular basis.
 
+        The hub sleeps until data arrives on one of the interfacers or
+        until the next interfacer or setup task is due.
+
         """
 
         # Set signal handler to catch SIGINT and shutdown gracefully
         signal.signal(signal.SIGINT, self._sigint_handler)
+
+        if self._loop is not None:
+            self._loop.run([self._loop.spawn(self._run_async(), 'hub')])
+            return
         
         # Until asked to stop
         while not self._exit:
-            
-            # Run setup and update settings if modified
-            self._setup.run()
-            if self._setup.check_settings():
-                self._update_settings(self._setup.settings)
-            
-            # For all Interfacers
-            for I in self._interfacers.itervalues():
-                # Execute run method
-                I.run()
-                # Read socket
-                values = I.read()
-                # If complete and valid data was received
-                if values is not None:
-                    # Place a copy of the values in a queue for each reporter
-                    for name in self._reporters:
-                        # discard if reporter 'pause' set to 'all' or 'in'
-                        if 'pause' in self._reporters[name]._settings \
-                                and str(self._reporters[name]._settings['pause']).lower() in \
-                                ['all', 'in']:
-                            continue
-                        self._queue[name].put(values)
-
-            # Sleep until next iteration
-            time.sleep(0.2)
+            self._run_once()
+
+            # Sleep until data is received or a task is due
+            self._wait()
+
+    def _run_async(self):
+        """Run the hub as an event loop task, see run()"""
+
+        while not self._exit:
+            self._run_once()
+            fds, timeout = self._get_wait()
+            yield ehl.Wait(fds, timeout=timeout)
+
+    def _run_once(self):
+        """Check the settings, read the interfacers and queue their frames"""
+
+        # Run setup and update settings if modified
+        self._setup.run()
+        if self._setup.check_settings():
+            self._update_settings(self._setup.settings)
+
+        # Log the instrumentation snapshot if due
+        ehm.run()
+        
+        # For all Interfacers
+        for I in self._interfacers.itervalues():
+            # Execute run method
+            I.run()
+            # Read socket, processing every complete frame received
+            frames = I.read_batch()
+            # If complete and valid data was received
+            if frames:
+                # Place the batch of frames once in the queue shared by all reporters
+                started = ehm.start()
+                self._queue.put(frames)
+                ehm.record(I.name, 'fanout', started)
+
+    def _wait(self):
+        """Block until an interfacer has data to read or a timer expires."""
+
+        fds, timeout = self._get_wait()
+        if not fds:
+            time.sleep(timeout)
+            return
+
+        try:
+            select.select(fds, [], [], timeout)
+        except select.error as e:
+            # Interrupted by a signal (eg SIGINT), let the main loop check _exit
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def _get_wait(self):
+        """Return the file-like objects to wait on and the longest time to wait (None: no limit)"""
+
+        fds = self._setup.get_fds()
+        timeouts = [self._setup.get_timeout(), ehm.get_timeout()]
+        for I in self._interfacers.itervalues():
+            I_fds = I.get_fds()
+            if not I_fds:
+                # Interfacer can't be waited on, poll it regularly
+                timeouts.append(self._poll_interval)
+            fds.extend(I_fds)
+            timeouts.append(I.get_timeout())
+
+        # Wait for the earliest timer, or indefinitely if none is set
+        timeouts = [t for t in timeouts if t is not None]
+        timeout = min(timeouts) if timeouts else None
+        if not fds and timeout is None:
+            timeout = self._poll_interval
+        return fds, timeout
          
     def close(self):
         """Close hub. Do some cleanup before leaving."""
         
         self._log.info("Exiting hub...")
 
+        if self._metrics_server:
+            self._metrics_server.close()
+
         for I in self._interfacers.itervalues():
             I.close()
 
-        for R in self._reporters.itervalues():
+        for name, R in self._reporters.iteritems():
             R.stop = True
-            R.join()
+            self._queue.remove_cursor(name)
+            if self._loop is None:
+                R.join()
+        if self._loop is not None:
+            # Let the reporters finish the posts under way
+            self._loop.run(self._tasks.values())
 
         self._log.info("Exit completed")
         logging.shutdown()
 
+    def get_metrics(self):
+        """Return the state of the interfacers and reporters
+
+        Called from the metrics server thread.
+
+        Return a dict: {'time': timestamp, 'interfacers': {name: stats},
+        'reporters': {name: stats}, 'stages': instrumentation snapshot}
+
+        """
+
+        # Work on copies as the hub may add or remove some meanwhile
+        return {'time': time.time(),
+                'interfacers': dict((name, I.get_stats()) for name, I in self._interfacers.items()),
+                'reporters': dict((name, R.get_stats()) for name, R in self._reporters.items()),
+                'stages': ehm.snapshot()}
+
     def _sigint_handler(self, signal, frame):
         """Catch SIGINT (Ctrl+C)."""
         
@@ -133,6 +241,51 @@ class EmonHub(object):
         else:
             self._set_logging_level()
 
+        # Size of the queue shared by all reporters
+        queue_size = settings['hub'].get('queue_size', '100000')
+        if not str(queue_size).isdigit() or not int(queue_size):
+            self._log.warning("'%s' is not a valid setting for hub: queue_size" % queue_size)
+        else:
+            self._queue.resize(queue_size)
+
+        # Pipeline instrumentation
+        instrumentation = settings['hub'].get('instrumentation', 'off')
+        interval = settings['hub'].get('instrumentation_interval', 300)
+        if (instrumentation, interval) != self._instrumentation:
+            if ehm.configure(instrumentation, interval):
+                self._log.info("Instrumentation " + str(instrumentation).lower() +
+                               " (snapshot interval: " + str(interval) + "s)")
+            else:
+                self._log.warning("Instrumentation settings invalid: " + str(instrumentation) +
+                                  ", " + str(interval))
+            self._instrumentation = (instrumentation, interval)
+
+        # Metrics endpoint, restarted if its address changed
+        address = (settings['hub'].get('metrics_bind', '127.0.0.1'), settings['hub'].get('metrics_port', '0'))
+        if address != self._metrics_address:
+            self._metrics_address = address
+            if self._metrics_server:
+                self._metrics_server.close()
+                self._metrics_server = None
+            if not str(address[1]).isdigit():
+                self._log.warning("'%s' is not a valid setting for hub: metrics_port" % address[1])
+            elif int(address[1]):
+                try:
+                    self._metrics_server = ehm.MetricsServer(self.get_metrics, address[1], address[0])
+                except ehm.MetricsServerInitError as e:
+                    self._log.error("Unable to start metrics server: " + str(e))
+                else:
+                    self._log.info("Serving metrics on http://%s:%s/metrics" % address)
+
+        # Interfacers in worker processes, all recreated when switched
+        multiprocess = str(settings['hub'].get('multiprocess', 'off')).lower()
+        if multiprocess not in ['on', 'off']:
+            self._log.warning("'%s' is not a valid setting for hub: multiprocess" % multiprocess)
+        elif (multiprocess == 'on') != self._multiprocess:
+            self._multiprocess = multiprocess == 'on'
+            self._log.info("Interfacers running in " +
+                           ("worker processes" if self._multiprocess else "the hub process"))
+
         # Create a place to hold buffer contents whilst a deletion & rebuild occurs
         self.temp_buffer = {}
         
@@ -156,11 +309,22 @@ class EmonHub(object):
                     if self._reporters[name].init_settings == settings['reporters'][name]['init_settings']:
                         continue
                     else:
-                        if self._reporters[name].buffer._data_buffer:
-                            self.temp_buffer[name]= self._reporters[name].buffer._data_buffer
+                        buf = self._reporters[name].buffer
+                        # A persistent buffer is picked up from disk by the new reporter
+                        if buf.hasItems() and not buf.isPersistent():
+                            self.temp_buffer[name] = buf.retrieveItems(buf.size())
             # Delete reporters if setting changed or name is unlisted or Type is missing
             self._log.info("Deleting reporter '%s'", name)
             self._reporters[name].stop = True
+            self._queue.remove_cursor(name)
+            # Wait for the reporter to close a persistent buffer before it is reopened
+            if self._reporters[name].buffer.isPersistent():
+                if self._loop is None:
+                    self._reporters[name].join()
+                else:
+                    # The hub runs in the loop too, stop the task right away
+                    self._loop.cancel(self._tasks[name])
+            self._tasks.pop(name, None)
             del(self._reporters[name])
         for name, R in settings['reporters'].iteritems():
             # If reporter does not exist, create it
@@ -169,26 +333,31 @@ class EmonHub(object):
                     if not 'Type' in R:
                         continue
                     self._log.info("Creating " + R['Type'] + " '%s' ", name)
-                    # Create the queue for this reporter
-                    self._queue[name] = Queue.Queue(0)
-                    # This gets the class from the 'Type' string
-                    reporter = getattr(ehr, R['Type'])(name, self._queue[name], **R['init_settings'])
+                    # This gets the class from the 'Type' string, the reporter
+                    # reads the shared queue through its own cursor
+                    reporter = getattr(ehr, R['Type'])(name, self._queue.cursor(name), **R['init_settings'])
                     reporter.set(**R['runtimesettings'])
                     reporter.init_settings = R['init_settings']
                     # If a memory buffer back-up exists copy it over and remove the back-up
                     if name in self.temp_buffer:
-                        reporter.buffer._data_buffer = self.temp_buffer[name]
+                        reporter.buffer.storeItems(self.temp_buffer[name])
                         del self.temp_buffer[name]
                 except ehr.EmonHubReporterInitError as e:
                     # If reporter can't be created, log error and skip to next
                     self._log.error("Failed to create '" + name + "' reporter: " + str(e))
+                    self._queue.remove_cursor(name)
                     continue
                 except Exception as e:
                     # If reporter can't be created, log error and skip to next
                     self._log.error("Unable to create '" + name + "' reporter: " + str(e))
+                    self._queue.remove_cursor(name)
                     continue
                 else:
                     self._reporters[name] = reporter
+                    if self._loop is not None:
+                        self._tasks[name] = self._loop.spawn(reporter.run_async(), name)
+                    else:
+                        reporter.start()
             else:
                 # Otherwise just update the runtime settings if possible
                 if 'runtimesettings' in R:
@@ -211,7 +380,8 @@ class EmonHub(object):
                     continue
                 else:
                     # check init_settings against the file copy, if they are the same move on to the next
-                    if self._interfacers[name].init_settings == settings['interfacers'][name]['init_settings']:
+                    if self._interfacers[name].init_settings == settings['interfacers'][name]['init_settings'] \
+                            and isinstance(self._interfacers[name], ehi.EmonHubInterfacerProcess) == self._multiprocess:
                         continue
             self._interfacers[name].close()
             self._log.info("Deleting interfacer '%s' ", name)
@@ -223,9 +393,14 @@ class EmonHub(object):
                     if not 'Type' in I:
                         continue
                     self._log.info("Creating " + I['Type'] + " '%s' ", name)
-                    # This gets the class from the 'Type' string
-                    interfacer = getattr(ehi, I['Type'])(name, **I['init_settings'])
-                    interfacer.set(**I['runtimesettings'])
+                    if self._multiprocess:
+                        # The worker gets the class from the 'Type' string
+                        interfacer = ehi.EmonHubInterfacerProcess(name, I['Type'], I['init_settings'],
+                                                                  I['runtimesettings'])
+                    else:
+                        # This gets the class from the 'Type' string
+                        interfacer = getattr(ehi, I['Type'])(name, **I['init_settings'])
+                        interfacer.set(**I['runtimesettings'])
                     interfacer.init_settings = I['init_settings']
                 except ehi.EmonHubInterfacerInitError as e:
                     # If interfacer can't be created, log error and skip to next
@@ -242,8 +417,9 @@ class EmonHub(object):
                 if 'runtimesettings' in I:
                     self._interfacers[name].set(**I['runtimesettings'])
 
+        # Nodes, recompiling their decoders only if changed
         if 'nodes' in settings:
-            ehc.nodelist = settings['nodes']
+            ehc.set_nodelist(settings['nodes'])
 
     def _set_logging_level(self, level='WARNING', log=True):
         """Set logging level.
@@ -7,7 +7,17 @@
 
 """
 
+import os
+import time
+import fcntl
+import struct
+import zlib
+import itertools
+import collections
+import errno
+import select
 import logging
+import threading
 
 """class AbstractBuffer
 
@@ -20,6 +30,10 @@ class AbstractBuffer():
     def storeItem(self, data):
         raise NotImplementedError
 
+    def storeItems(self, items):
+        for data in items:
+            self.storeItem(data)
+
     def retrieveItems(self, number):
         raise NotImplementedError
 
@@ -35,73 +49,805 @@ class AbstractBuffer():
     def hasItems(self): 
         raise NotImplementedError
 
+    def isPersistent(self):
+        """True if the items survive the buffer being closed"""
+        return False
+
+    def getSyncTimeout(self):
+        """Seconds until sync() has writes to commit, None if there are none"""
+        return None
+
+    def sync(self):
+        """Commit the writes due to be committed"""
+        pass
+
+    def close(self):
+        pass
+
 """
 This implementation of the AbstractBuffer just uses an in-memory data structure.
-It's basically identical to the previous (inline) buffer.
+
+Items are held in a deque so storing and discarding are O(1) whatever the
+number of items held. When full, the overflow policy decides which items are
+lost:
+    'drop-oldest'       the oldest item is deleted to make room (default)
+    'drop-newest'       the new item is not stored
+    'thin-every-other'  every other item is deleted, halving the resolution
+                        of the buffered data but keeping its whole time span
 """
 
 
 class InMemoryBuffer(AbstractBuffer):
-  
-    def __init__(self, bufferName, buffer_size):
+
+    overflowPolicies = ['drop-oldest', 'drop-newest', 'thin-every-other']
+
+    def __init__(self, bufferName, buffer_size, overflow='drop-oldest'):
         self._bufferName = str(bufferName)
         self._buffer_type = "memory"
         self._maximumEntriesInBuffer = int(buffer_size)
-        self._data_buffer = []
+        self._data_buffer = collections.deque()
         self._log = logging.getLogger("EmonHub")
 
+        if overflow not in self.overflowPolicies:
+            self._log.warning("'%s' is not a valid overflow policy for %s buffer, using 'drop-oldest'"
+                              % (overflow, self._bufferName))
+            overflow = 'drop-oldest'
+        self._overflow = overflow
+
+        # Number of items lost since the buffer became full
+        self._discarded = 0
+
     def hasItems(self):
         return self.size() > 0
 
     def isFull(self):
         return self.size() >= self._maximumEntriesInBuffer
 
-    def getMaxEntrySliceIndex(self):
-        return max(0,
-                   self.size() - self._maximumEntriesInBuffer - 1)
+    def makeRoom(self):
+        """Apply the overflow policy to a full buffer.
 
-    def discardOldestItems(self):
-        self._data_buffer = self._data_buffer[self.getMaxEntrySliceIndex():]
+        Return False if the new item must not be stored.
 
-    def discardOldestItemsIfFull(self):
-        if self.isFull():
+        """
+
+        if not self._discarded:
             self._log.warning(
-                "In-memory buffer (%s) reached limit of %d items, deleting oldest"
-                % (self._bufferName, self._maximumEntriesInBuffer))
-        self.discardOldestItems()
+                "In-memory buffer (%s) reached limit of %d items, applying '%s' policy"
+                % (self._bufferName, self._maximumEntriesInBuffer, self._overflow))
+
+        if self._overflow == 'drop-newest':
+            self._discarded += 1
+            return False
+        elif self._overflow == 'thin-every-other':
+            # O(n), but only once every n/2 items stored
+            kept = collections.deque(itertools.islice(self._data_buffer, 0, None, 2))
+            self._discarded += self.size() - len(kept)
+            self._data_buffer = kept
+        else:
+            self._data_buffer.popleft()
+            self._discarded += 1
+        return True
 
     def storeItem(self, data):
-        self.discardOldestItemsIfFull()
+        if self.isFull():
+            if not self.makeRoom():
+                return
+        elif self._discarded:
+            self._log.warning("In-memory buffer (%s) discarded %d items while full"
+                              % (self._bufferName, self._discarded))
+            self._discarded = 0
         self._data_buffer.append(data)
 
+    def storeItems(self, items):
+        # Fast path when there is room for the whole batch
+        if self.size() + len(items) <= self._maximumEntriesInBuffer and not self._discarded:
+            self._data_buffer.extend(items)
+            return
+        for data in items:
+            self.storeItem(data)
+
     def retrieveItem(self):
         return self._data_buffer[0]
 
     def retrieveItems(self, number):
-        blen = len(self._data_buffer)
-        if number > blen:
-            number = blen
-        return self._data_buffer[:number]
+        # Only the references to the requested items are copied
+        return list(itertools.islice(self._data_buffer, number))
 
     def discardLastRetrievedItem(self):
-        del self._data_buffer[0]
+        self._data_buffer.popleft()
 
     def discardLastRetrievedItems(self, number):
-        blen = len(self._data_buffer)
-        if number > blen:
-            number = blen
-        self._data_buffer = self._data_buffer[number:]
+        popleft = self._data_buffer.popleft
+        for i in xrange(min(number, self.size())):
+            popleft()
 
     def size(self):
         return len(self._data_buffer)
 
 
+"""
+Items are stored in a compact binary form by the buffers that don't hold them
+as Python objects: a count of values, one struct type code per value, then
+the values packed little-endian with those codes.
+"""
+
+# Cache of struct.Struct instances by type codes
+_itemStructs = {}
+
+
+def _typeCode(value):
+    if isinstance(value, bool):
+        return '?'
+    elif isinstance(value, (int, long)):
+        if -0x80000000 <= value < 0x80000000:
+            return 'i'
+        elif -0x8000000000000000 <= value < 0x8000000000000000:
+            return 'q'
+        return 'Q'
+    elif isinstance(value, float):
+        return 'd'
+    elif isinstance(value, str) and len(value) == 1:
+        return 'c'
+    raise ValueError("Can't pack %r" % (value,))
+
+
+def packItem(item):
+    """Return item (a list of numbers) packed as a string"""
+
+    codes = ''.join([_typeCode(v) for v in item])
+    s = _itemStructs.get(codes)
+    if s is None:
+        s = _itemStructs[codes] = struct.Struct('<' + codes)
+    return struct.pack('<H', len(codes)) + codes + s.pack(*item)
+
+
+def unpackItem(data, offset=0):
+    """Unpack an item packed by packItem() at offset in data
+
+    Return the item and the offset following it.
+
+    """
+
+    n, = struct.unpack_from('<H', data, offset)
+    offset += 2
+    codes = data[offset:offset + n]
+    offset += n
+    s = _itemStructs.get(codes)
+    if s is None:
+        s = _itemStructs[codes] = struct.Struct('<' + codes)
+    return list(s.unpack_from(data, offset)), offset + s.size
+
+def _checkOverflow(overflow, bufferName, bufferType):
+    """Return the overflow policy of a buffer that can drop the oldest or newest items"""
+
+    if overflow not in ['drop-oldest', 'drop-newest']:
+        logging.getLogger("EmonHub").warning(
+            "'%s' is not a valid overflow policy for %s buffer (%s), using 'drop-oldest'"
+            % (overflow, bufferType, bufferName))
+        overflow = 'drop-oldest'
+    return overflow
+
+
+def _dropNewest(buffer, items):
+    """Return the items a full buffer with the 'drop-newest' policy has room for"""
+
+    if buffer._overflow != 'drop-newest':
+        return items
+    room = max(0, buffer._maximumEntriesInBuffer - buffer._count)
+    if len(items) > room:
+        if not buffer._discarded:
+            buffer._log.warning("%s buffer (%s) reached limit of %d items, applying 'drop-newest' policy"
+                                % (buffer._buffer_type.capitalize(), buffer._bufferName,
+                                   buffer._maximumEntriesInBuffer))
+        buffer._discarded += len(items) - room
+        return items[:room]
+    if buffer._discarded:
+        buffer._log.warning("%s buffer (%s) discarded %d items while full"
+                            % (buffer._buffer_type.capitalize(), buffer._bufferName, buffer._discarded))
+        buffer._discarded = 0
+    return items
+
+"""
+This implementation of the AbstractBuffer keeps the items on disk, so they
+survive a restart or a power loss.
+
+Items are appended to segment files as records, each made of a header (length
+and CRC32 of the packed item) followed by the packed item. Files are written
+sequentially, never rewritten. The position of the oldest item not yet
+discarded is kept in a 'cursor' file, so discarding items only moves the
+cursor, and whole segments are deleted once all their items are discarded.
+
+Writes are flushed to the OS at every store and fsync'ed, together with the
+cursor, at most every sync_interval seconds (group commit). On start up, a
+record left incomplete by a crash is truncated and reading resumes from the
+saved cursor.
+"""
+
+
+class DiskBuffer(AbstractBuffer):
+
+    _recordHeader = struct.Struct('<II')
+
+    def __init__(self, bufferName, buffer_size, buffer_path='/var/lib/emonhub',
+                 segment_size=1048576, sync_interval=1, overflow='drop-oldest'):
+        self._bufferName = str(bufferName)
+        self._buffer_type = "disk"
+        self._maximumEntriesInBuffer = int(buffer_size)
+        self._overflow = _checkOverflow(overflow, self._bufferName, self._buffer_type)
+        self._segmentSize = int(segment_size)
+        self._syncInterval = float(sync_interval)
+        self._log = logging.getLogger("EmonHub")
+
+        self._path = os.path.join(buffer_path, self._bufferName)
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+        # Segment numbers on disk, oldest first
+        self._segments = sorted(int(f[:-4]) for f in os.listdir(self._path)
+                                if f.endswith('.seg') and f[:-4].isdigit())
+        if not self._segments:
+            self._segments = [0]
+
+        # Repair the segment being written after a crash and open it for appending
+        self._writeSegment = self._segments[-1]
+        self._recover(self._writeSegment)
+        self._writer = open(self._segmentFile(self._writeSegment), 'ab')
+        self._writeOffset = os.path.getsize(self._segmentFile(self._writeSegment))
+
+        # Restore the position of the oldest item
+        self._cursor = self._loadCursor()
+        self._savedCursor = self._cursor
+        self._lastSync = time.time()
+        self._dirty = False
+
+        # Positions following each item of the last retrieveItems() call
+        self._retrieved = []
+
+        # Number of new items not stored since the buffer became full
+        self._discarded = 0
+
+        # Count the items left to send
+        self._count = sum(1 for pos in self._scan(self._cursor, None, False))
+        if self._count:
+            self._log.info("Disk buffer (%s) resuming with %d items" % (self._bufferName, self._count))
+
+    def _segmentFile(self, segment):
+        return os.path.join(self._path, '%010d.seg' % segment)
+
+    def _recover(self, segment):
+        """Truncate an incomplete or corrupted record at the end of segment"""
+
+        filename = self._segmentFile(segment)
+        if not os.path.exists(filename):
+            return
+        end = 0
+        for item, pos in self._scan((segment, 0), None, True, False):
+            end = pos[1]
+        if end != os.path.getsize(filename):
+            self._log.warning("Disk buffer (%s) truncating %d bytes of incomplete data in %s"
+                              % (self._bufferName, os.path.getsize(filename) - end, filename))
+            with open(filename, 'r+b') as f:
+                f.truncate(end)
+
+    def _loadCursor(self):
+        try:
+            with open(os.path.join(self._path, 'cursor')) as f:
+                segment, offset = [int(v) for v in f.read().split()]
+        except (IOError, ValueError):
+            return (self._segments[0], 0)
+        if segment not in self._segments:
+            return (self._segments[0], 0)
+        return (segment, offset)
+
+    def _saveCursor(self):
+        filename = os.path.join(self._path, 'cursor')
+        with open(filename + '.tmp', 'w') as f:
+            f.write('%d %d' % self._cursor)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(filename + '.tmp', filename)
+        self._savedCursor = self._cursor
+
+    def _scan(self, start, number, unpack=True, multi=True):
+        """Read records from position start (segment, offset)
+
+        Yield (item, position following the item) for up to number items
+        (None for all), item being None if unpack is False. Stop at the end
+        of the first segment if multi is False, or at the first invalid record.
+
+        """
+
+        segment, offset = start
+        for seg in self._segments:
+            if seg < segment:
+                continue
+            if seg > segment:
+                if not multi:
+                    return
+                offset = 0
+            try:
+                f = open(self._segmentFile(seg), 'rb')
+            except IOError:
+                continue
+            with f:
+                f.seek(offset)
+                while number is None or number > 0:
+                    header = f.read(8)
+                    if len(header) < 8:
+                        break
+                    length, crc = self._recordHeader.unpack(header)
+                    data = f.read(length)
+                    if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                        # Expected at the end of a segment when recovering from a crash
+                        if multi:
+                            self._log.warning("Disk buffer (%s) invalid record in segment %d at %d"
+                                              % (self._bufferName, seg, offset))
+                        return
+                    offset += 8 + length
+                    if number is not None:
+                        number -= 1
+                    yield (unpackItem(data)[0] if unpack else None), (seg, offset)
+            if number == 0:
+                return
+
+    def _sync(self, force=False):
+        """fsync written data and save the cursor, at most every sync interval"""
+
+        now = time.time()
+        if not force and now - self._lastSync < self._syncInterval:
+            return
+        self._lastSync = now
+        if self._dirty:
+            os.fsync(self._writer.fileno())
+            self._dirty = False
+        if self._cursor != self._savedCursor:
+            self._saveCursor()
+            # Delete the segments all discarded
+            while self._segments[0] < self._cursor[0]:
+                os.remove(self._segmentFile(self._segments.pop(0)))
+
+    def getSyncTimeout(self):
+        if not self._dirty and self._cursor == self._savedCursor:
+            return None
+        return max(0, self._lastSync + self._syncInterval - time.time())
+
+    def sync(self):
+        self._sync()
+
+    def hasItems(self):
+        return self._count > 0
+
+    def isPersistent(self):
+        return True
+
+    def isFull(self):
+        return self._count >= self._maximumEntriesInBuffer
+
+    def size(self):
+        return self._count
+
+    def storeItem(self, data):
+        self.storeItems([data])
+
+    def storeItems(self, items):
+        items = _dropNewest(self, items)
+        if not items:
+            return
+        records = []
+        for data in items:
+            packed = packItem(data)
+            records.append(self._recordHeader.pack(len(packed), zlib.crc32(packed) & 0xffffffff))
+            records.append(packed)
+        records = ''.join(records)
+
+        self._writer.write(records)
+        self._writer.flush()
+        self._writeOffset += len(records)
+        self._dirty = True
+        self._count += len(items)
+
+        # Start a new segment once the current one is full
+        if self._writeOffset >= self._segmentSize:
+            self._writer.close()
+            self._writeSegment += 1
+            self._segments.append(self._writeSegment)
+            self._writer = open(self._segmentFile(self._writeSegment), 'ab')
+            self._writeOffset = 0
+            # Make sure the previous segment is on disk
+            self._sync(True)
+
+        # Drop the oldest items when full
+        if self._count > self._maximumEntriesInBuffer and self._overflow == 'drop-oldest':
+            excess = self._count - self._maximumEntriesInBuffer
+            self._log.warning("Disk buffer (%s) reached limit of %d items, deleting %d oldest"
+                              % (self._bufferName, self._maximumEntriesInBuffer, excess))
+            self._retrieved = []
+            self.discardLastRetrievedItems(excess)
+
+        self._sync()
+
+    def retrieveItem(self):
+        return self.retrieveItems(1)[0]
+
+    def retrieveItems(self, number):
+        items = []
+        self._retrieved = []
+        for item, pos in self._scan(self._cursor, min(number, self._count)):
+            items.append(item)
+            self._retrieved.append(pos)
+        return items
+
+    def discardLastRetrievedItem(self):
+        self.discardLastRetrievedItems(1)
+
+    def discardLastRetrievedItems(self, number):
+        number = min(number, self._count)
+        if not number:
+            return
+        if number <= len(self._retrieved):
+            self._cursor = self._retrieved[number - 1]
+        else:
+            for item, pos in self._scan(self._cursor, number, False):
+                self._cursor = pos
+        self._retrieved = []
+        self._count -= number
+
+        # Move on to the next segment once all items of a full one are discarded
+        segment, offset = self._cursor
+        if segment != self._writeSegment and offset >= os.path.getsize(self._segmentFile(segment)):
+            self._cursor = (self._segments[self._segments.index(segment) + 1], 0)
+
+        self._sync()
+
+    def close(self):
+        self._sync(True)
+        self._writer.close()
+
+
+"""
+This implementation of the AbstractBuffer keeps the items in memory in a
+compact form, to ride through longer outages on hubs with little RAM.
+
+New items are collected in a tail list. Every block_size items, the block is
+sealed: its items are packed and the block is zlib compressed. Only the
+oldest block is decompressed again, into the head list, when its items are
+retrieved. When full, the oldest items are deleted.
+"""
+
+
+class CompressedBuffer(AbstractBuffer):
+
+    def __init__(self, bufferName, buffer_size, block_size=256, compression_level=6, overflow='drop-oldest'):
+        self._bufferName = str(bufferName)
+        self._buffer_type = "compressed"
+        self._maximumEntriesInBuffer = int(buffer_size)
+        self._overflow = _checkOverflow(overflow, self._bufferName, self._buffer_type)
+        self._blockSize = int(block_size)
+        self._compressionLevel = int(compression_level)
+        self._log = logging.getLogger("EmonHub")
+
+        # Oldest items decompressed and the position of the first not yet discarded
+        self._head = []
+        self._headPos = 0
+        # Sealed blocks as (compressed data, number of items), oldest first
+        self._blocks = collections.deque()
+        # Newest items, not yet sealed into a block
+        self._tail = []
+        self._count = 0
+
+        # Number of items lost since the buffer became full
+        self._discarded = 0
+
+    def hasItems(self):
+        return self._count > 0
+
+    def isFull(self):
+        return self._count >= self._maximumEntriesInBuffer
+
+    def size(self):
+        return self._count
+
+    def _seal(self):
+        """Pack and compress the tail into a new block"""
+
+        data = ''.join([packItem(data) for data in self._tail])
+        self._blocks.append((zlib.compress(data, self._compressionLevel), len(self._tail)))
+        self._tail = []
+
+    def _unseal(self):
+        """Decompress the oldest block and append its items to the head"""
+
+        compressed, count = self._blocks.popleft()
+        data = zlib.decompress(compressed)
+        offset = 0
+        head = self._head
+        for i in xrange(count):
+            item, offset = unpackItem(data, offset)
+            head.append(item)
+
+    def storeItem(self, data):
+        self.storeItems([data])
+
+    def storeItems(self, items):
+        items = _dropNewest(self, items)
+        for data in items:
+            self._tail.append(data)
+            if len(self._tail) >= self._blockSize:
+                self._seal()
+        self._count += len(items)
+
+        # Delete the oldest items when full
+        if self._count > self._maximumEntriesInBuffer:
+            excess = self._count - self._maximumEntriesInBuffer
+            if not self._discarded:
+                self._log.warning("Compressed buffer (%s) reached limit of %d items, deleting oldest"
+                                  % (self._bufferName, self._maximumEntriesInBuffer))
+            self._discarded += excess
+            self.discardLastRetrievedItems(excess)
+        elif self._discarded and not self.isFull():
+            self._log.warning("Compressed buffer (%s) discarded %d items while full"
+                              % (self._bufferName, self._discarded))
+            self._discarded = 0
+
+    def retrieveItem(self):
+        return self.retrieveItems(1)[0]
+
+    def retrieveItems(self, number):
+        # Decompress as many blocks as needed into the head
+        while len(self._head) - self._headPos < number and self._blocks:
+            self._unseal()
+        items = self._head[self._headPos:self._headPos + number]
+        # Then complete with the newest items
+        if len(items) < number:
+            items.extend(self._tail[:number - len(items)])
+        return items
+
+    def discardLastRetrievedItem(self):
+        self.discardLastRetrievedItems(1)
+
+    def discardLastRetrievedItems(self, number):
+        number = min(number, self._count)
+        self._count -= number
+
+        # Items from the head
+        n = min(number, len(self._head) - self._headPos)
+        self._headPos += n
+        number -= n
+        if self._headPos >= len(self._head):
+            self._head = []
+            self._headPos = 0
+
+        # Whole blocks are dropped without decompressing them
+        while self._blocks and self._blocks[0][1] <= number:
+            number -= self._blocks.popleft()[1]
+
+        # Part of a block
+        if number and self._blocks:
+            self._unseal()
+            self._headPos = number
+            number = 0
+
+        # Items from the tail
+        if number:
+            del self._tail[:number]
+
+
+"""class FanoutRing
+
+Passes frames from the hub to all the reporters.
+
+Each frame is held once in a fixed size ring shared by all reporters. Each
+reporter reads through its own cursor, so the cost of adding frames does not
+depend on the number of reporters. A reporter lagging more than the size of
+the ring loses the oldest frames.
+"""
+
+
+class FanoutRing(object):
+
+    def __init__(self, size=100000):
+        self._size = int(size)
+        self._ring = [None] * self._size
+        # Total number of frames put in the ring so far
+        self._head = 0
+        # Position of each reader's cursor
+        self._cursors = {}
+        self._lock = threading.Lock()
+        self._log = logging.getLogger("EmonHub")
+
+    def cursor(self, name):
+        """Register a reader starting at the current head and return its cursor"""
+
+        cursor = FanoutCursor(self, name)
+        with self._lock:
+            self._cursors[cursor] = self._head
+        return cursor
+
+    def remove_cursor(self, name):
+        """Unregister the reader(s) called 'name' and wake them up if waiting"""
+
+        with self._lock:
+            for cursor in self._cursors.keys():
+                if cursor.name == name:
+                    del self._cursors[cursor]
+                    cursor.wake()
+
+    def put(self, frames):
+        """Add a batch of frames for all readers"""
+
+        with self._lock:
+            size = self._size
+            for frame in frames:
+                self._ring[self._head % size] = frame
+                self._head += 1
+            # Wake up the readers waiting for new frames
+            for cursor in self._cursors:
+                if cursor.waiting:
+                    cursor.waiting = False
+                    cursor.wake()
+
+    def get(self, cursor, timeout=0):
+        """Return all the frames not yet read through cursor and advance it
+
+        timeout (float): seconds to wait for new frames if there are none yet,
+        None to wait until there are
+
+        """
+
+        if timeout != 0:
+            if self.arm(cursor):
+                cursor.wait(timeout)
+                cursor.waiting = False
+
+        with self._lock:
+            pos = self._cursors.get(cursor)
+            if pos is None or pos == self._head:
+                return []
+            head = self._head
+            size = self._size
+
+            # Skip frames already overwritten by the producer
+            lost = head - pos - size
+            if lost > 0:
+                self._log.warning("Queue for '%s' overrun, %d frames lost" % (cursor.name, lost))
+                cursor.overruns += lost
+                pos += lost
+
+            # Copy out in at most two slices (before and after wrap around)
+            start, end = pos % size, head % size
+            if start < end:
+                frames = self._ring[start:end]
+            else:
+                frames = self._ring[start:] + self._ring[:end]
+
+            # Release the frames every reader is now done with
+            oldest = min(self._cursors.itervalues())
+            self._cursors[cursor] = head
+            newest = min(self._cursors.itervalues())
+            if newest > oldest:
+                self._release(oldest, newest)
+            return frames
+
+    def resize(self, size):
+        """Change the number of frames held, keeping the newest unread ones"""
+
+        size = int(size)
+        with self._lock:
+            if size == self._size:
+                return
+            ring = [None] * size
+            oldest = min(self._cursors.itervalues()) if self._cursors else self._head
+            for pos in xrange(max(oldest, self._head - self._size, self._head - size), self._head):
+                ring[pos % size] = self._ring[pos % self._size]
+            self._ring = ring
+            self._size = size
+
+    def arm(self, cursor):
+        """Have put() wake up cursor's reader, unless there are frames to read already
+
+        Return True if the reader is to wait.
+
+        """
+
+        with self._lock:
+            cursor.waiting = self._cursors.get(cursor) == self._head
+            return cursor.waiting
+
+    def _release(self, start, end):
+        """Drop the ring's references to frames from position start to end"""
+
+        size = self._size
+        # Positions older than the ring's size now hold newer frames
+        start = max(start, end - size, self._head - size)
+        for pos in xrange(start, end):
+            self._ring[pos % size] = None
+
+    def lag(self, cursor):
+        """Return the number of frames waiting to be read through cursor"""
+
+        with self._lock:
+            if cursor not in self._cursors:
+                return 0
+            return min(self._head - self._cursors[cursor], self._size)
+
+"""class FanoutCursor
+
+A reporter's view of the FanoutRing
+
+A reader waiting for frames blocks on its own pipe, which the ring writes to
+when new frames are put (a Condition with a timeout would poll in Python 2).
+"""
+
+
+class FanoutCursor(object):
+
+    def __init__(self, ring, name):
+        self._ring = ring
+        self.name = name
+        # Number of frames lost because the reader lagged too far behind
+        self.overruns = 0
+        # Set while the reader is waiting for frames
+        self.waiting = False
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def __del__(self):
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+    def get(self, timeout=0):
+        """Return all new frames, oldest first, waiting up to timeout seconds for some"""
+        return self._ring.get(self, timeout)
+
+    def empty(self):
+        return self._ring.lag(self) == 0
+
+    def lag(self):
+        return self._ring.lag(self)
+
+    def arm(self):
+        """Get woken up by the next frames put, return False if some are waiting already"""
+        return self._ring.arm(self)
+
+    def fileno(self):
+        """Return the fd readable once woken up, to wait in a select() loop"""
+        return self._rfd
+
+    def wake(self):
+        """Interrupt the reader's wait"""
+
+        try:
+            os.write(self._wfd, 'x')
+        except OSError as e:
+            # Pipe already full, the reader will wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout=None):
+        """Block until woken up or timeout seconds have passed"""
+
+        try:
+            select.select([self._rfd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+        # Clear wake up notifications
+        try:
+            while os.read(self._rfd, 512):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
 """
 The getBuffer function returns the buffer class corresponding to a 
 buffering method passed as argument.
 """
 bufferMethodMap = {
-                   'memory': InMemoryBuffer
+                   'memory': InMemoryBuffer,
+                   'disk': DiskBuffer,
+                   'compressed': CompressedBuffer
                   }
 
 
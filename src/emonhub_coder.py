@@ -1,32 +1,169 @@
+import re
 import struct
+import itertools
+
+# NumPy is optional, it speeds up decoding large batches of frames
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Initialize nodes data
 nodelist = {}
 
+# Data types & sizes (number of bytes)
+datasizes = {'b': 1, 'h': 2, 'i': 4, 'l': 4, 'q': 8, 'f': 4, 'd': 8,
+             'B': 1, 'H': 2, 'I': 4, 'L': 4, 'Q': 8, 'c': 1, '?': 1}
 
-def check_datacode(datacode):
+# Compiled decoders by string of datacodes
+_structs = {}
+
+# NumPy types matching the datacodes ('c' is decoded by struct only)
+numpy_types = {'b': 'i1', 'h': '<i2', 'i': '<i4', 'l': '<i4', 'q': '<i8', 'f': '<f4', 'd': '<f8',
+               'B': 'u1', 'H': '<u2', 'I': '<u4', 'L': '<u4', 'Q': '<u8', '?': 'b1'}
+
+# Smallest batch of frames decoded with NumPy
+batch_threshold = 16
+
+# NumPy structured dtypes by string of datacodes
+_dtypes = {}
+
+# Anything but unsigned integers in a batch of payloads
+_not_bytes = re.compile('[^0-9 ]')
 
-    # Data types & sizes (number of bytes)
-    datacodes = {'b': '1', 'h': '2', 'i': '4', 'l': '4', 'q': '8', 'f': '4', 'd': '8',
-                 'B': '1', 'H': '2', 'I': '4', 'L': '4', 'Q': '8', 'c': '1', '?': '1'}
+# Compiled decoders of the nodes listed with per value 'datacodes', by node ID
+# (None if the node's datacodes are not valid)
+_node_structs = {}
+
+
+def check_datacode(datacode):
 
     # if datacode is valid return the data size in bytes
-    if datacode in datacodes:
-        return int(datacodes[datacode])
     # if not valid return False
-    else:
+    return datasizes.get(datacode, False)
+
+
+def compile_datacodes(datacodes):
+    """Return a struct.Struct decoding a payload made of datacodes
+
+    datacodes (string or list): datacodes of the values, in order
+
+    Values are decoded little-endian with standard sizes. The Struct is
+    cached, None is returned if a datacode is not valid.
+
+    """
+
+    key = ''.join(datacodes)
+    s = _structs.get(key)
+    if s is None:
+        if not all(check_datacode(code) for code in datacodes):
+            return None
+        s = _structs[key] = struct.Struct('<' + key)
+    return s
+
+
+def set_nodelist(nodes):
+    """Update the nodes settings and recompile the nodes decoders if changed
+
+    nodes (dict): settings by node ID, as in the [nodes] section
+
+    Return True if the settings were changed.
+
+    """
+
+    global nodelist
+
+    # Take a copy as the settings object is updated in place on reload
+    nodes = dict((node, dict(settings)) for node, settings in nodes.iteritems())
+    if nodes == nodelist:
         return False
 
+    nodelist = nodes
+    _node_structs.clear()
+    for node, settings in nodelist.iteritems():
+        if 'datacodes' in settings:
+            _node_structs[node] = compile_datacodes(settings['datacodes'])
+    return True
 
-def decode(datacode, frame):
-    # Ensure little-endian & standard sizes used
-    e = '<'
 
-    # set the base data type to bytes
-    b = 'B'
+def get_node_struct(node):
+    """Return the compiled decoder of a node listed with per value 'datacodes'"""
+
+    return _node_structs.get(node)
+
+
+def decode_batch(decoder, payloads):
+    """Decode many payloads sharing the same layout
+
+    decoder (struct.Struct): as returned by compile_datacodes()
+    payloads (list): payloads as lists of byte values (ints or numerical
+        strings), decoder.size long
+
+    Batches of batch_threshold payloads or more are decoded in one go with
+    NumPy if available, the result is the same as decoding each payload.
+
+    Return a list of the decoded values of each payload, None for a payload
+    that can't be decoded.
+
+    """
+
+    if numpy is not None and len(payloads) >= batch_threshold:
+        decoded = _decode_batch_numpy(decoder, payloads)
+        if decoded is not None:
+            return decoded
+
+    decoded = []
+    for payload in payloads:
+        try:
+            if payload and isinstance(payload[0], str):
+                payload = [int(v) for v in payload]
+            decoded.append(list(decoder.unpack_from(bytearray(payload))))
+        except (ValueError, TypeError, struct.error):
+            decoded.append(None)
+    return decoded
+
+
+def _decode_batch_numpy(decoder, payloads):
+    """Decode payloads with a NumPy structured dtype, or return None if not possible"""
+
+    codes = decoder.format[1:]
+    if not codes or not all(code in numpy_types for code in codes):
+        return None
+
+    # Concatenate the payloads into one buffer, checking they are all valid bytes
+    if isinstance(payloads[0][0], str):
+        # Convert all the numerical strings at once
+        text = ' '.join([' '.join(payload) for payload in payloads])
+        if _not_bytes.search(text):
+            return None
+        data = numpy.fromstring(text, dtype=numpy.int64, sep=' ')
+        if data.size and (data.min() < 0 or data.max() > 255):
+            return None
+        data = data.astype(numpy.uint8)
+    else:
+        # bytearray() rejects anything but ints in range(256)
+        try:
+            data = numpy.frombuffer(bytearray(list(itertools.chain.from_iterable(payloads))),
+                                    dtype=numpy.uint8)
+        except (ValueError, TypeError):
+            return None
+    if data.size != len(payloads) * decoder.size:
+        return None
+
+    dtype = _dtypes.get(codes)
+    if dtype is None:
+        dtype = _dtypes[codes] = numpy.dtype([('v%d' % i, numpy_types[code])
+                                              for i, code in enumerate(codes)])
+
+    # Reinterpret each payload's bytes as one record of values
+    records = data.view(dtype)
+    return [list(values) for values in records.tolist()]
+
+
+def decode(datacode, frame):
 
-    # get data size from data code
-    s = int(check_datacode(datacode))
+    # get the cached decoder for a single value of datacode
+    s = compile_datacodes(datacode[0])
 
-    result = struct.unpack(e + datacode[0], struct.pack(e + b*s, *frame))
+    result = s.unpack_from(bytearray(frame))
     return result[0]
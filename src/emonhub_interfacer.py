@@ -8,13 +8,32 @@
 """
 
 import serial
+import os
+import sys
 import time
 import datetime
+import struct
 import logging
 import socket
 import select
+import errno
+import signal
+import json
+import marshal
+import multiprocessing
 
 import emonhub_coder as ehc
+import emonhub_metrics as ehm
+
+
+def _to_number(val):
+    """Convert a numerical string to an int or, if that fails, a float"""
+
+    try:
+        return int(val)
+    except ValueError:
+        return float(val)
+
 
 """class EmonHubInterfacer
 
@@ -36,10 +55,19 @@ class EmonHubInterfacer(object):
         # Initialise settings
         self.name = name
         self.init_settings = {}
-        self._defaults = {'pause': 'off', 'interval': 0, 'datacode': '0', 'timestamped': 'False'}
+        self._defaults = {'pause': 'off', 'interval': 0, 'datacode': '0', 'timestamped': 'False',
+                          'capture': '', 'capture_size': '10485760', 'capture_files': '5'}
         self._settings = {}
         self._packet_counter = 0
 
+        # Capture file of the lines received, and its settings
+        self._capture = None
+        self._capture_settings = ('', None, None)
+
+        # Frames received, and discarded by reason
+        self._received = 0
+        self._discarded = {}
+
         # This line will stop the default values printing to logfile at start-up
         # unless they have been overwritten by emonhub.conf entries
         # comment out if diagnosing a startup value issue
@@ -50,7 +78,7 @@ class EmonHubInterfacer(object):
         
     def close(self):
         """Close socket."""
-        pass
+        self._close_capture()
 
     def read(self):
         """Read data from socket and process if complete line received.
@@ -60,6 +88,21 @@ class EmonHubInterfacer(object):
         """
         pass
 
+    def read_batch(self):
+        """Read data from socket and process every complete line received.
+
+        Subclasses holding several frames at once should override this so
+        that everything already buffered is processed in one call.
+
+        Return a list of frames, each as returned by read()
+
+        """
+
+        frame = self.read()
+        if frame is None:
+            return []
+        return [frame]
+
     def _process_frame(self, frame, timestamp=0.0):
         """Process a frame of data
 
@@ -68,62 +111,130 @@ class EmonHubInterfacer(object):
         This function splits the string into numbers and check its validity.
 
         'NodeID val1 val2 ...' is the generic data format. If the source uses 
-        a different format, override this method.
+        a different format, override _validate_frame().
         
         Return data as a list: [NodeID, val1, val2]
 
         """
 
-        # Discard the frame if 'pause' set to 'all' or 'in'
+        frames = self._process_frames([(frame, timestamp)])
+        if frames:
+            return frames[0]
+
+    def _process_frames(self, lines):
+        """Process a batch of frames of data
+
+        lines (list): [(frame, timestamp), ...] as passed to _process_frame()
+
+        Each frame is validated on its own, then the frames sharing the same
+        datacodes are decoded together.
+
+        Return a list of frames, each as returned by _process_frame()
+
+        """
+
+        self._received += len(lines)
+
+        # Keep a copy of the lines as received
+        if self._capture is not None:
+            self._write_capture(lines)
+
+        # Discard the frames if 'pause' set to 'all' or 'in'
         if 'pause' in self._settings and \
                         str.lower(self._settings['pause']) in ['all', 'in']:
-            return
+            self._count_discarded('paused', len(lines))
+            return []
 
-        # Add timestamp if not done already
+        # Time the stages only if instrumentation is on
+        started = ehm.start()
 
-        if not timestamp:
-            timestamp = round(time.time(), 2)
+        # Frames in order as [ref, timestamp, node, payload or decoded values, rssi]
+        pending = []
+        # Frames to decode, by decoder
+        batches = {}
 
-        # Assign a "Packet" reference number
-        self._packet_counter +=1
-        ref = self._packet_counter
+        # Build the debug messages only if they are going to be logged
+        debug = self._log.isEnabledFor(logging.DEBUG)
 
-        # Log data
-        self._log.debug(str(ref) + " NEW FRAME : " + str(timestamp) + " " + frame)
-        
-        # Get an array out of the space separated string
-        frame = frame.strip().split(' ')
+        for frame, timestamp in lines:
 
-        # create a RSSI variable
-        self.rssi = False
+            # Add timestamp if not done already
+            if not timestamp:
+                timestamp = round(time.time(), 2)
 
-        # Validate frame
-        validated = self._validate_frame(ref, frame)
-        if not validated:
-            #self._log.debug('Discard RX Frame "Failed validation"')
-            return
-        else:
-            frame = self._decode_frame(ref, validated)
+            # Assign a "Packet" reference number
+            self._packet_counter +=1
+            ref = self._packet_counter
 
-        if frame:
-            self._log.debug(str(ref) + " Timestamp : " + str(timestamp))
-            self._log.debug(str(ref) + "      Node : " + str(frame[0]))
-            self._log.debug(str(ref) + "    Values : " + str(frame[1:]))
-            frame = [timestamp] + frame
-            # Append RSSI only if value is not 'False'
-            if self.rssi:
-                self._log.debug(str(ref) + "      RSSI : " + str(self.rssi))
-                frame += [self.rssi]
-            frame += [ref]
-        else:
-            return
+            # Log data
+            if debug:
+                self._log.debug(str(ref) + " NEW FRAME : " + str(timestamp) + " " + frame)
+
+            # Get an array out of the space separated string
+            frame = frame.strip().split(' ')
+
+            # create a RSSI variable
+            self.rssi = False
+
+            # Validate frame, its values are converted to numbers on the way
+            validated = self._validate_frame(ref, frame)
+            if not validated:
+                continue
+
+            node = validated[0]
+            payload = validated[1:]
+            decoder = self._get_decoder(ref, str(node), payload)
+            if decoder is False:
+                continue
+
+            entry = [ref, timestamp, node, payload, self.rssi]
+            if decoder is None:
+                # No datacode, pass values back as numerical values
+                entry[3] = self._decode_numbers(payload)
+            else:
+                batches.setdefault(decoder, []).append(entry)
+            pending.append(entry)
+
+        # Decode the payloads of each decoder in one go
+        decode_started = started and time.time()
+        for decoder, entries in batches.iteritems():
+            decoded = ehc.decode_batch(decoder, [entry[3] for entry in entries])
+            for entry, values in zip(entries, decoded):
+                if values is None:
+                    self._log.warning(str(entry[0]) + " Unable to decode as values incorrect for datacode(s)")
+                    self._count_discarded('unable to decode')
+                entry[3] = values
+        if started:
+            ehm.record(self.name, 'decode', decode_started)
 
         # pause output if 'pause' set to 'all' or 'out'
         if 'pause' in self._settings \
                 and str(self._settings['pause']).lower() in ['all', 'out']:
-            return
-        
-        return frame
+            self._count_discarded('paused', len([entry for entry in pending if entry[3] is not None]))
+            return []
+
+        frames = []
+        for ref, timestamp, node, decoded, rssi in pending:
+            if decoded is None:
+                continue
+            if debug:
+                self._log.debug(str(ref) + " Timestamp : " + str(timestamp))
+                self._log.debug(str(ref) + "      Node : " + str(node))
+                self._log.debug(str(ref) + "    Values : " + str(decoded))
+            frame = [timestamp, node] + decoded
+            # Append RSSI only if value is not 'False'
+            if rssi:
+                if debug:
+                    self._log.debug(str(ref) + "      RSSI : " + str(rssi))
+                frame += [rssi]
+            frame += [ref]
+            frames.append(frame)
+
+        if started:
+            ehm.count(self.name, 'frames', len(lines))
+            ehm.count(self.name, 'accepted', len(frames))
+            ehm.record(self.name, 'process', started)
+        return frames
 
     def _validate_frame(self, ref, received):
         """Validate a frame of data
@@ -131,7 +242,10 @@ class EmonHubInterfacer(object):
         This function performs logical tests to filter unsuitable data.
         Each test discards frame with a log entry if False
 
-        Returns True if data frame passes tests.
+        Each value is converted once, to an int or, if that fails, a float.
+
+        Returns the frame as [NodeID, val1, val2, ...] with an int NodeID
+        if data frame passes tests.
 
         """
         
@@ -139,23 +253,31 @@ class EmonHubInterfacer(object):
         # with number of elements at least 2
         if len(received) < 2:
             self._log.warning(str(ref) + " Discarded RX frame 'string too short' : " + str(received))
+            self._count_discarded('string too short')
             return False
 
         # Discard if anything non-numerical found
         try:
-            [float(val) for val in received]
-        except Exception:
-            self._log.warning(str(ref) + " Discarded RX frame 'non-numerical content' : " + str(received))
-            return False
+            # Frames are usually integers only, convert them all in one go
+            values = map(int, received)
+        except ValueError:
+            try:
+                values = [_to_number(val) for val in received]
+            except ValueError:
+                self._log.warning(str(ref) + " Discarded RX frame 'non-numerical content' : " + str(received))
+                self._count_discarded('non-numerical content')
+                return False
             
         # Discard if first value is not a valid node id
-        n = float(received[0])
+        n = values[0]
         if n % 1 != 0 or n < 0 or n > 31:
             self._log.warning(str(ref) + " Discarded RX frame 'node id outside scope' : " + str(received))
+            self._count_discarded('node id outside scope')
             return False
+        values[0] = int(n)
 
         # If it passes all the checks return
-        return received
+        return values
 
     def _decode_frame(self, ref, data):
         """Decodes a frame of data
@@ -168,75 +290,92 @@ class EmonHubInterfacer(object):
 
         node = data[0]
         data = data[1:]
-        decoded = []
+
+        decoder = self._get_decoder(ref, str(node), data)
+        if decoder is False:
+            return False
+        elif decoder is None:
+            # when no (default)datacode(s) specified, pass values back as numerical values
+            decoded = self._decode_numbers(data)
+        else:
+            # Decode the whole frame of data in one go into "decoded"
+            decoded = ehc.decode_batch(decoder, [data])[0]
+            if decoded is None:
+                self._log.warning(str(ref) + " Unable to decode as values incorrect for datacode(s)")
+                self._count_discarded('unable to decode')
+                return False
+
+        # Insert node ID before data
+        decoded.insert(0, int(node))
+        return decoded
+
+    def _get_decoder(self, ref, node, data):
+        """Find how to decode the data of a frame
+
+        Returns the node's (cached) struct.Struct decoder, None if the values
+        need no decoding or False if the frame must be discarded.
+
+        """
 
         # check if node is listed and has individual datacodes for each value
         if node in ehc.nodelist and 'datacodes' in ehc.nodelist[node]:
             # fetch the string of datacodes
             datacodes = ehc.nodelist[node]['datacodes']
-            # fetch a string of data sizes based on the string of datacodes
-            datasizes = []
-            for code in datacodes:
-                datasizes.append(ehc.check_datacode(code))
+            # fetch the decoder precompiled for the node's datacodes
+            decoder = ehc.get_node_struct(node)
             # Discard the frame & return 'False' if it doesn't match the summed datasizes
-            if len(data) != sum(datasizes):
+            if decoder is None or len(data) != decoder.size:
                 self._log.warning(str(ref) + " RX data length: " + str(len(data)) +
                                   " is not valid for datacodes " + str(datacodes))
+                self._count_discarded('invalid data length')
                 return False
-            else:
-                # Determine the expected number of values to be decoded
-                count = len(datacodes)
-                # Set decoder to "Per value" decoding using datacode 'False' as flag
-                datacode = False
+            return decoder
+
+        # if node is listed, but has only a single default datacode for all values
+        if node in ehc.nodelist and 'datacode' in ehc.nodelist[node]:
+            datacode = ehc.nodelist[node]['datacode']
         else:
-            # if node is listed, but has only a single default datacode for all values
-            if node in ehc.nodelist and 'datacode' in ehc.nodelist[node]:
-                datacode = ehc.nodelist[node]['datacode']
-            else:
-            # when node not listed or has no datacode(s) use the interfacers default if specified
-                datacode = self._settings['datacode']
-            # Ensure only int 0 is passed not str 0
-            if datacode == '0':
-                datacode = 0
-            # when no (default)datacode(s) specified, pass string values back as numerical values
-            if not datacode:
-                for val in data:
-                    if float(val) % 1 != 0:
-                        val = float(val)
-                    else:
-                        val = int(float(val))
-                    decoded.append(val)
-            # Discard frame if total size is not an exact multiple of the specified datacode size.
-            elif len(data) % ehc.check_datacode(datacode) != 0:
-                self._log.warning(str(ref) + " RX data length: " + str(len(data)) +
-                                  " is not valid for datacode " + str(datacode))
+        # when node not listed or has no datacode(s) use the interfacers default if specified
+            datacode = self._settings['datacode']
+        # Ensure only int 0 is passed not str 0
+        if datacode == '0':
+            datacode = 0
+        # when no (default)datacode(s) specified, values need no decoding
+        if not datacode:
+            if not data:
+                self._log.warning(str(ref) + " Unable to decode as values incorrect for datacode(s)")
+                self._count_discarded('unable to decode')
                 return False
-            else:
-            # Determine the number of values in the frame of the specified code & size
-                count = len(data) / ehc.check_datacode(datacode)
-
-        # Decode the string of data one value at a time into "decoded"
-        if not decoded:
-            bytepos = int(0)
-            for i in range(0, count, 1):
-                # Use single datacode unless datacode = False then use datacodes
-                dc = datacode
-                if not datacode:
-                    dc = datacodes[i]
-                # Determine the number of bytes to use for each value by it's datacode
-                size = int(ehc.check_datacode(dc))
-                try:
-                    value = ehc.decode(dc, [int(v) for v in data[bytepos:bytepos+size]])
-                except:
-                    self._log.warning(str(ref) + " Unable to decode as values incorrect for datacode(s)")
-                    return False
-                bytepos += size
-                decoded.append(value)
+            return None
+        # Discard frame if total size is not an exact multiple of the specified datacode size.
+        size = ehc.check_datacode(datacode)
+        if not size or len(data) % size != 0:
+            self._log.warning(str(ref) + " RX data length: " + str(len(data)) +
+                              " is not valid for datacode " + str(datacode))
+            self._count_discarded('invalid data length')
+            return False
+        # Get the (cached) decoder for the number of values in the frame of the specified code & size
+        return ehc.compile_datacodes(datacode * (len(data) / size))
 
-        # Insert node ID before data
-        decoded.insert(0, int(node))
-        return decoded
+    def _decode_numbers(self, data):
+        """Return the values of a frame, integral floats as ints"""
+
+        return [int(val) if type(val) is float and val % 1 == 0 else val for val in data]
     
+    def _count_discarded(self, reason, n=1):
+        """Count frames discarded for reason"""
+
+        self._discarded[reason] = self._discarded.get(reason, 0) + n
+
+    def get_stats(self):
+        """Return the number of frames received, and discarded by reason
+
+        Return a dict: {'received': n, 'discarded': {reason: n}}
+
+        """
+
+        return {'received': self._received, 'discarded': dict(self._discarded)}
+
     def set(self, **kwargs):
         """Set configuration parameters.
 
@@ -266,12 +405,52 @@ class EmonHubInterfacer(object):
                 pass
             elif key == 'timestamped' and str(setting).lower() in ['true', 'false']:
                 pass
+            elif key == 'capture':
+                pass
+            elif key in ['capture_size', 'capture_files'] and str(setting).isdigit() and int(setting) > 0:
+                pass
             else:
                 self._log.warning("'%s' is not a valid setting for %s: %s" % (str(setting), self.name, key))
                 continue
             self._settings[key] = setting
             self._log.debug("Setting " + self.name + " " + key + ": " + str(setting))
 
+        self._set_capture()
+
+    def _set_capture(self):
+        """Open, reopen or close the capture file as set"""
+
+        settings = (str(self._settings['capture']), int(self._settings['capture_size']),
+                    int(self._settings['capture_files']))
+        if settings == self._capture_settings:
+            return
+        self._capture_settings = settings
+        self._close_capture()
+        if settings[0]:
+            try:
+                self._capture = EmonHubCaptureFile(*settings)
+            except (IOError, OSError) as e:
+                self._log.warning(self.name + " unable to open capture file: " + str(e))
+            else:
+                self._log.info(self.name + " capturing received lines to " + settings[0])
+
+    def _write_capture(self, lines):
+        """Append lines to the capture file, stop capturing if that fails"""
+
+        try:
+            self._capture.write(lines)
+        except (IOError, OSError) as e:
+            self._log.warning(self.name + " unable to write capture file, capture stopped: " + str(e))
+            self._close_capture()
+
+    def _close_capture(self):
+        if self._capture is not None:
+            try:
+                self._capture.close()
+            except (IOError, OSError):
+                pass
+            self._capture = None
+
     def run(self):
         """Placeholder for background tasks. 
         
@@ -281,6 +460,23 @@ class EmonHubInterfacer(object):
         """
         pass
 
+    def get_fds(self):
+        """Return the file-like objects the hub should wait on for incoming data.
+
+        An interfacer returning an empty list cannot be waited on and is
+        polled instead.
+
+        """
+        return []
+
+    def get_timeout(self):
+        """Return the number of seconds until run() next has work to do.
+
+        None means there is no housekeeping scheduled.
+
+        """
+        return None
+
     def _open_serial_port(self, com_port, com_baud):
         """Open serial port
 
@@ -302,10 +498,11 @@ class EmonHubInterfacer(object):
         else:
             return s
     
-    def _open_socket(self, port_nb):
+    def _open_socket(self, port_nb, backlog=1):
         """Open a socket
 
         port_nb (string): port number on which to open the socket
+        backlog (int): number of pending connections allowed by listen()
 
         """
 
@@ -314,7 +511,7 @@ class EmonHubInterfacer(object):
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.bind(('', int(port_nb)))
-            s.listen(1)
+            s.listen(backlog)
         except socket.error as e:
             self._log.error(e)
             raise EmonHubInterfacerInitError('Could not open port %s' %
@@ -354,6 +551,12 @@ class EmonHubSerialInterfacer(EmonHubInterfacer):
         if self._ser is not None:
             self._log.debug("Closing serial port")
             self._ser.close()
+        super(EmonHubSerialInterfacer, self).close()
+
+    def get_fds(self):
+        """Return the serial port so the hub can wait for data on it"""
+
+        return [self._ser]
 
     def read(self):
         """Read data from serial port and process if complete line received.
@@ -374,17 +577,53 @@ class EmonHubSerialInterfacer(EmonHubInterfacer):
 
         # Reset buffer
         self._rx_buf = ''
-        
+
+        line = self._prepare_line(f)
+        if line:
+            return self._process_frame(*line)
+
+    def read_batch(self):
+        """Read all data waiting on the serial port and process every complete line.
+
+        Return a list of frames: [[NodeID, val1, val2], ...]
+
+        """
+
+        # Read everything available without blocking
+        started = ehm.start()
+        self._rx_buf = self._rx_buf + self._ser.read(self._ser.inWaiting())
+        ehm.record(self.name, 'read', started)
+
+        # If no complete line, exit
+        if '\r\n' not in self._rx_buf:
+            return []
+
+        # Keep any incomplete line in the buffer for next time
+        lines = self._rx_buf.split('\r\n')
+        self._rx_buf = lines.pop()
+
+        # Process all data frames together
+        lines = [self._prepare_line(f) for f in lines]
+        return self._process_frames([line for line in lines if line])
+
+    def _prepare_line(self, f):
+        """Prepare a line received from the serial port, without CR,LF.
+
+        Return the data frame and its timestamp, or None if not a data frame
+
+        """
+
         # Discard empty frames
         if not f:
             self._log.warning("Discarded empty frame")
+            self._received += 1
+            self._count_discarded('empty frame')
             return
 
         # unix timestamp
         t = round(time.time(), 2)
 
-        # Process data frame
-        return self._process_frame(f, t)
+        return f, t
 
 """class EmonHubJeeInterfacer
 
@@ -459,29 +698,18 @@ class EmonHubJeeInterfacer(EmonHubSerialInterfacer):
         if all(i in self.info[1] for i in (" i", " g", " @ ", " MHz")):
             self._settings.update(self._jee_settings)
 
-    def read(self):
-        """Read data from serial port and process if complete line received.
+    def _prepare_line(self, f):
+        """Prepare a line received from the "Jee" device, without CR,LF.
 
-        Return data as a list: [NodeID, val1, val2]
+        Return the data frame and its timestamp, or None if not a data frame
 
         """
 
-        # Read serial RX
-        self._rx_buf = self._rx_buf + self._ser.readline()
-
-        # If line incomplete, exit
-        if '\r\n' not in self._rx_buf:
-            return
-
-        # Remove CR,LF
-        f = self._rx_buf[:-2]
-
-        # Reset buffer
-        self._rx_buf = ''
-        
         # Discard empty frames
         if not f:
             self._log.warning("Discarded empty frame")
+            self._received += 1
+            self._count_discarded('empty frame')
             return
 
         # Discard information messages
@@ -505,8 +733,7 @@ class EmonHubJeeInterfacer(EmonHubSerialInterfacer):
         # unix timestamp
         t = round(time.time(), 2)
 
-        # Process data frame
-        return self._process_frame(f, t)
+        return f, t
 
     def _validate_frame(self, ref, received):
         """Validate a frame of data
@@ -514,32 +741,24 @@ class EmonHubJeeInterfacer(EmonHubSerialInterfacer):
         This function performs logical tests to filter unsuitable data.
         Each test discards frame with a log entry if False
 
-        Returns True if data frame passes tests.
+        Returns the frame as [NodeID, val1, val2, ...] with an int NodeID
+        if data frame passes tests.
 
         """
 
-        if received[0] == '?'and str(received[-1])[0]=='(' and str(received[-1])[-1]==')':
-            self._log.info(str(ref) + " Discard RX frame 'unreliable content' : RSSI " + str(received[-1]))
+        stripped = _strip_jee_frame(self, ref, received)
+        if stripped is None:
             return False
-
-        # Strip 'OK' from frame if needed
-        if received[0]=='OK':
-            received = received[1:]
-
-        # extract RSSI if packet is from RFM69 type Jee Device
-        if str(received[-1])[0]=='(' and str(received[-1])[-1]==')':
-            self.rssi = int(received[-1][1:-1])
-            received = received[:-1]
-            return received
-        else:
-            # set RSSI false for standard frames so RSSI is not re-appended later
-            self.rssi = False
+        received, rssi = stripped
 
         # include checks from parent
-        if not super(EmonHubJeeInterfacer, self)._validate_frame(ref, received):
+        validated = super(EmonHubJeeInterfacer, self)._validate_frame(ref, received)
+        if not validated:
             return False
 
-        return received
+        # RSSI is false for standard frames so it is not re-appended later
+        self.rssi = rssi
+        return validated
 
     def set(self, **kwargs):
         """Send configuration parameters to the "Jee" type device through COM port
@@ -601,6 +820,14 @@ class EmonHubJeeInterfacer(EmonHubSerialInterfacer):
             if now - self._interval_timestamp > interval:
                 self._send_time()
                 self._interval_timestamp = now
+
+    def get_timeout(self):
+        """Return the number of seconds until the next time broadcast is due"""
+
+        interval = int(self._settings['interval'])
+        if not interval:
+            return None
+        return max(0, self._interval_timestamp + interval - time.time())
     
     def _send_time(self):
         """Send time over radio link to synchronize emonGLCD
@@ -619,6 +846,38 @@ class EmonHubJeeInterfacer(EmonHubSerialInterfacer):
 
         self._ser.write("00,%02d,%02d,00,s" % (now.hour, now.minute))
 
+
+def _strip_jee_frame(interfacer, ref, received):
+    """Strip the RSSI and 'OK' a "Jee" device adds to a frame
+
+    Return the frame's fields without them and the RSSI (False if none), or
+    None if the interfacer discards the frame.
+
+    """
+
+    rssi = False
+    last = received[-1]
+    if last[:1] == '(' and last[-1:] == ')':
+        if received[0] == '?':
+            interfacer._log.info(str(ref) + " Discard RX frame 'unreliable content' : RSSI " + last)
+            interfacer._count_discarded('unreliable content')
+            return
+        # extract RSSI if packet is from RFM69 type Jee Device
+        try:
+            rssi = int(last[1:-1])
+        except ValueError:
+            interfacer._log.warning(str(ref) + " Discarded RX frame 'non-numerical content' : " + str(received))
+            interfacer._count_discarded('non-numerical content')
+            return
+        received = received[:-1]
+
+    # Strip 'OK' from frame if needed
+    if received and received[0] == 'OK':
+        received = received[1:]
+
+    return received, rssi
+
+
 """class EmonHubSocketInterfacer
 
 Monitors a socket for data, typically from ethernet link
@@ -651,6 +910,12 @@ class EmonHubSocketInterfacer(EmonHubInterfacer):
         if self._socket is not None:
             self._log.debug('Closing socket')
             self._socket.close()
+        super(EmonHubSocketInterfacer, self).close()
+
+    def get_fds(self):
+        """Return the listening socket so the hub can wait for connections"""
+
+        return [self._socket]
 
     def read(self):
         """Read data from socket and process if complete line received.
@@ -658,7 +923,43 @@ class EmonHubSocketInterfacer(EmonHubInterfacer):
         Return data as a list: [NodeID, val1, val2]
         
         """
-        
+
+        self._receive()
+
+        # If there is at least one complete frame in the buffer
+        if '\r\n' in self._sock_rx_buf:
+            # Process and return first frame in buffer:
+            f, self._sock_rx_buf = self._sock_rx_buf.split('\r\n', 1)
+            line = self._prepare_line(f)
+            if line is not None:
+                return self._process_frame(*line)
+
+    def read_batch(self):
+        """Read data from socket and process every complete line received.
+
+        Return a list of frames: [[NodeID, val1, val2], ...]
+
+        """
+
+        started = ehm.start()
+        self._receive()
+        ehm.record(self.name, 'read', started)
+
+        # If no complete frame in the buffer, exit
+        if '\r\n' not in self._sock_rx_buf:
+            return []
+
+        # Keep any incomplete frame in the buffer for next time
+        lines = self._sock_rx_buf.split('\r\n')
+        self._sock_rx_buf = lines.pop()
+
+        # Process all data frames together, less those with an invalid timestamp
+        lines = [self._prepare_line(f) for f in lines]
+        return self._process_frames([line for line in lines if line is not None])
+
+    def _receive(self):
+        """Accept a pending connection, if any, and add its data to the RX buffer"""
+
         # Check if data received
         ready_to_read, ready_to_write, in_error = \
             select.select([self._socket], [], [], 0)
@@ -675,17 +976,844 @@ class EmonHubSocketInterfacer(EmonHubInterfacer):
             # Close connection
             conn.close()
 
-        # If there is at least one complete frame in the buffer
-        if '\r\n' in self._sock_rx_buf:
-            # Process and return first frame in buffer:
-            f, self._sock_rx_buf = self._sock_rx_buf.split('\r\n', 1)
-            if str(self._settings['timestamped']).lower() == "true":
-                f = f.split(" ")
+    def _prepare_line(self, f):
+        """Prepare a line received from the socket, without CR,LF.
+
+        Return the data frame and its timestamp (0 if not timestamped), None
+        if the timestamp is not valid
+
+        """
+
+        if str(self._settings['timestamped']).lower() == "true":
+            f = f.split(" ")
+            try:
                 t = float(f[0])
-                f = ' '.join(map(str, f[1:]))
-                return self._process_frame(f, t)
+            except ValueError:
+                self._log.warning("Discarded RX frame 'invalid timestamp' : " + str(f))
+                # Received all the same, as the frames discarded by _process_frames()
+                self._received += 1
+                self._count_discarded('invalid timestamp')
+                return None
+            f = ' '.join(map(str, f[1:]))
+            return f, t
+        else:
+            return f, 0.0
+
+"""class EmonHubSocketStreamInterfacer
+
+Monitors a socket for data streamed over persistent connections, typically
+from several ethernet senders at once
+
+"""
+
+
+class EmonHubSocketStreamInterfacer(EmonHubSocketInterfacer):
+
+    def __init__(self, name, port_nb=50011, max_connections=64):
+        """Initialize Interfacer
+
+        port_nb (string): port number on which to open the socket
+        max_connections (string): maximum number of concurrent connections
+
+        """
+
+        # Initialization (skip the single connection socket set up by the parent)
+        EmonHubInterfacer.__init__(self, name)
+
+        # Open socket, allowing several senders to queue up for accept()
+        self._max_connections = int(max_connections)
+        self._socket = self._open_socket(port_nb, min(self._max_connections, socket.SOMAXCONN))
+        self._socket.setblocking(0)
+
+        # Initialize RX buffer for complete frames from all connections
+        self._sock_rx_buf = ''
+
+        # Open connections, each with its own framing buffer and counters
+        self._connections = {}
+
+        # Longest incomplete frame kept for a connection before discarding it
+        self._max_line_length = 4096
+
+    def close(self):
+        """Close all connections and the listening socket."""
+
+        for conn in self._connections.keys():
+            self._close_connection(conn)
+
+        super(EmonHubSocketStreamInterfacer, self).close()
+
+    def get_fds(self):
+        """Return the listening socket and every open connection"""
+
+        return [self._socket] + self._connections.keys()
+
+    def get_connections(self):
+        """Return the counters of each open connection, keyed by 'host:port'"""
+
+        return dict(('%s:%s' % c['addr'], {'frames': c['frames'], 'bytes': c['bytes'],
+                                           'discarded': c['discarded'], 'since': c['since']})
+                    for c in self._connections.values())
+
+    def get_stats(self):
+        """Return the frames received and discarded, and each connection's counters
+
+        Return a dict: {'received': n, 'discarded': {reason: n},
+                        'connections': {'host:port': {'frames': n, 'bytes': n,
+                                                      'discarded': n, 'since': t}}}
+
+        """
+
+        stats = super(EmonHubSocketStreamInterfacer, self).get_stats()
+        stats['connections'] = self.get_connections()
+        return stats
+
+    def _receive(self):
+        """Accept new connections and read every connection with data waiting.
+
+        Complete frames are moved from each connection's buffer to the
+        interfacer's RX buffer, incomplete frames are kept for next time.
+
+        """
+
+        ready_to_read, ready_to_write, in_error = \
+            select.select(self.get_fds(), [], [], 0)
+
+        for s in ready_to_read:
+            if s is self._socket:
+                self._accept()
+                continue
+
+            try:
+                data = s.recv(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    continue
+                self._log.warning(self.name + " connection error from %s:%s: " % self._connections[s]['addr'] + str(e))
+                data = ''
+
+            # An empty read means the sender closed the connection
+            if not data:
+                self._close_connection(s)
+                continue
+
+            c = self._connections[s]
+            c['bytes'] += len(data)
+            buf = c['buf'] + data
+
+            # Move all complete frames to the RX buffer
+            if '\r\n' in buf:
+                end = buf.rindex('\r\n') + 2
+                c['frames'] += buf.count('\r\n', 0, end)
+                self._sock_rx_buf = self._sock_rx_buf + buf[:end]
+                buf = buf[end:]
+
+            # Discard runaway data that never completes a frame
+            if len(buf) > self._max_line_length:
+                self._log.warning(self.name + " discarded %d bytes without end of frame from %s:%s"
+                                  % ((len(buf),) + c['addr']))
+                c['discarded'] += 1
+                buf = ''
+            c['buf'] = buf
+
+    def _accept(self):
+        """Accept every pending connection, up to the connection limit"""
+
+        while True:
+            try:
+                conn, addr = self._socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                self._log.warning(self.name + " could not accept connection: " + str(e))
+                return
+
+            if len(self._connections) >= self._max_connections:
+                self._log.warning(self.name + " refused connection from %s:%s, limit of %d connections reached"
+                                  % (addr + (self._max_connections,)))
+                conn.close()
+                continue
+
+            conn.setblocking(0)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self._connections[conn] = {'addr': addr, 'buf': '', 'frames': 0, 'bytes': 0,
+                                       'discarded': 0, 'since': time.time()}
+            self._log.debug(self.name + " connection from %s:%s" % addr)
+
+    def _close_connection(self, conn):
+        """Close a connection and log its counters"""
+
+        c = self._connections.pop(conn)
+        self._log.info(self.name + " connection from %s:%s closed after %.0f s: %d frames, %d bytes, %d discarded"
+                       % (c['addr'] + (time.time() - c['since'], c['frames'], c['bytes'], c['discarded'])))
+        conn.close()
+
+"""class EmonHubUDPInterfacer
+
+Receives frames as UDP datagrams ('NodeID val1 val2 ...', several lines per
+datagram allowed), saving senders the connection set up of the socket
+interfacer.
+
+Every datagram queued is read at each wake up, into a receive buffer sized
+for bursts. Datagrams the kernel dropped because that buffer was full are
+counted as discarded frames ('receive buffer overflow').
+
+"""
+
+
+class EmonHubUDPInterfacer(EmonHubSocketInterfacer):
+
+    # Most datagrams read at once, so that other interfacers get their turn
+    _max_batch = 10000
+
+    def __init__(self, name, port_nb=50011, bind='', rcvbuf=4194304):
+        """Initialize Interfacer
+
+        port_nb (string): UDP port number to receive datagrams on
+        bind (string): address to receive on (default: all)
+        rcvbuf (string): kernel receive buffer size in bytes, capped by
+            net.core.rmem_max on Linux
+
+        """
+
+        # Initialization (skip the TCP socket set up by the parent)
+        EmonHubInterfacer.__init__(self, name)
+
+        self._log.debug('Opening UDP socket on port %s', port_nb)
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(rcvbuf))
+            self._socket.bind((bind, int(port_nb)))
+        except socket.error as e:
+            self._log.error(e)
+            raise EmonHubInterfacerInitError('Could not open UDP port %s' % port_nb)
+        self._socket.setblocking(0)
+
+        # Linux reports twice the size set, to account for its bookkeeping
+        size = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if size < int(rcvbuf):
+            self._log.warning(self.name + " receive buffer limited to " + str(size) +
+                              " bytes, raise net.core.rmem_max to allow " + str(rcvbuf))
+
+        # Initialize RX buffer for the lines received
+        self._sock_rx_buf = ''
+
+        # Datagrams dropped by the kernel, as last read and when, and whether
+        # datagrams came in since (so more may have been dropped)
+        self._inode = os.fstat(self._socket.fileno()).st_ino
+        self._drops = self._read_drops()
+        self._drops_checked = time.time()
+        self._drops_pending = False
+
+    def _receive(self):
+        """Read every datagram queued and add its lines to the RX buffer"""
+
+        recv = self._socket.recv
+        datagrams = []
+        try:
+            for i in xrange(self._max_batch):
+                datagrams.append(recv(65535))
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._log.warning(self.name + " unable to receive: " + str(e))
+
+        if datagrams:
+            # Frames end with CR,LF, LF or the end of the datagram
+            lines = [line for line in '\n'.join(datagrams).replace('\r', '').split('\n') if line]
+            if lines:
+                self._sock_rx_buf += '\r\n'.join(lines) + '\r\n'
+            self._drops_pending = True
+
+    def run(self):
+        """Count the datagrams dropped by the kernel, at most once a second"""
+
+        if self._drops_pending and time.time() - self._drops_checked >= 1:
+            self._check_drops()
+
+    def get_timeout(self):
+        """Return the number of seconds until the drops are next counted"""
+
+        if not self._drops_pending:
+            return None
+        return max(0, self._drops_checked + 1 - time.time())
+
+    def _read_drops(self):
+        """Return the number of datagrams dropped by the kernel for the socket
+
+        From /proc/net/udp, None if not available (eg. not on Linux)
+
+        """
+
+        try:
+            with open('/proc/net/udp') as f:
+                for line in f:
+                    fields = line.split()
+                    # sl local rem st tx:rx tr:when retrnsmt uid timeout inode ref pointer drops
+                    if len(fields) > 12 and fields[9] == str(self._inode):
+                        return int(fields[12])
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def _check_drops(self):
+        """Count the datagrams dropped by the kernel since last checked
+
+        Only from the thread reading the socket, get_stats() may be called
+        from another one.
+
+        """
+
+        self._drops_checked = time.time()
+        self._drops_pending = False
+        drops = self._read_drops()
+        if drops is None or self._drops is None:
+            return
+        if drops > self._drops:
+            self._log.warning(self.name + " receive buffer overflow, " + str(drops - self._drops) +
+                              " datagrams dropped")
+            self._count_discarded('receive buffer overflow', drops - self._drops)
+        self._drops = drops
+
+"""class EmonHubReplayInterfacer
+
+Feeds the lines saved in a capture file (see the 'capture' setting) back
+through the pipeline, at the pace they were received ('speed' = 1), N times
+faster ('speed' = N) or as fast as possible ('speed' = max).
+
+Lines are validated as the generic interfacers do, or as the "Jee" one does
+('format' = jee), and decoded with the datacode and nodes settings in use.
+They get the time they are replayed at ('timestamps' = now) or the one they
+had, if any ('timestamps' = original).
+
+"""
+
+
+class EmonHubReplayInterfacer(EmonHubInterfacer):
+
+    # Most lines processed at once at maximum speed
+    _max_batch = 1000
+
+    def __init__(self, name, capture_file=''):
+        """Initialize Interfacer
+
+        capture_file (string): capture file, replayed after its rotated
+            copies (capture_file.N, ..., capture_file.1) if any
+
+        """
+
+        # Initialization
+        super(EmonHubReplayInterfacer, self).__init__(name)
+
+        if not os.path.isfile(capture_file):
+            raise EmonHubInterfacerInitError("Capture file not found: " + str(capture_file))
+        self._capture_file = capture_file
+
+        self._replay_settings = {'speed': '1', 'loop': 'off', 'format': 'generic', 'timestamps': 'now'}
+        self._settings.update(self._replay_settings)
+
+        self._open_replay()
+
+    def _open_replay(self):
+        """Start replaying from the first line"""
+
+        self._records = read_capture(self._capture_file)
+        self._next = next(self._records, None)
+        # Time the replay started at, and capture time of the line replayed then
+        self._start = None
+        self._first = None
+        self._replayed = 0
+
+    def set(self, **kwargs):
+        """Set the replay settings, and the settings common to all interfacers
+
+        speed (string): '1' to replay lines at the pace they were received,
+            'N' to replay them N times faster, 'max' as fast as possible
+        loop (string): 'on' to start over at the end of the capture
+        format (string): 'generic' or 'jee', as captured
+        timestamps (string): 'now' or 'original'
+
+        """
+
+        for key, setting in self._replay_settings.iteritems():
+            if key in kwargs.keys():
+                setting = kwargs[key]
+            if self._settings[key] == setting:
+                continue
+            elif key == 'speed' and (str(setting).lower() == 'max' or _is_positive(setting)):
+                # Carry on from the next line at the new speed
+                self._start = None
+            elif key == 'loop' and str(setting).lower() in ['on', 'off']:
+                pass
+            elif key == 'format' and str(setting).lower() in ['generic', 'jee']:
+                pass
+            elif key == 'timestamps' and str(setting).lower() in ['now', 'original']:
+                pass
             else:
-                return self._process_frame(f)
+                self._log.warning("'%s' is not a valid setting for %s: %s" % (str(setting), self.name, key))
+                continue
+            self._settings[key] = setting
+            self._log.debug("Setting " + self.name + " " + key + ": " + str(setting))
+
+        # include kwargs from parent
+        super(EmonHubReplayInterfacer, self).set(**kwargs)
+
+    def read_batch(self):
+        """Process the lines due to be replayed
+
+        Return a list of frames: [[NodeID, val1, val2], ...]
+
+        """
+
+        if self._next is None:
+            return []
+
+        now = time.time()
+        if self._start is None:
+            self._start, self._first = now, self._next[0]
+        speed = str(self._settings['speed']).lower()
+        original = str(self._settings['timestamps']).lower() == 'original'
+
+        lines = []
+        while self._next is not None and len(lines) < self._max_batch:
+            arrival, timestamp, frame = self._next
+            if speed != 'max' and self._start + (arrival - self._first) / float(speed) > now:
+                break
+            lines.append((frame, timestamp if original else 0.0))
+            self._next = next(self._records, None)
+        self._replayed += len(lines)
+
+        if self._next is None:
+            self._log.info(self.name + " replayed " + str(self._replayed) + " lines in %.1f s"
+                           % (time.time() - self._start))
+            if str(self._settings['loop']).lower() == 'on':
+                self._open_replay()
+
+        if not lines:
+            return []
+        return self._process_frames(lines)
+
+    def _validate_frame(self, ref, received):
+        """Validate a frame as the captured interfacer did"""
+
+        if str(self._settings['format']).lower() != 'jee':
+            return super(EmonHubReplayInterfacer, self)._validate_frame(ref, received)
+
+        stripped = _strip_jee_frame(self, ref, received)
+        if stripped is None:
+            return False
+        received, rssi = stripped
+        validated = super(EmonHubReplayInterfacer, self)._validate_frame(ref, received)
+        if not validated:
+            return False
+        self.rssi = rssi
+        return validated
+
+    def get_timeout(self):
+        """Return the number of seconds until the next line is due"""
+
+        if self._next is None:
+            return None
+        speed = str(self._settings['speed']).lower()
+        if speed == 'max' or self._start is None:
+            return 0
+        return max(0, self._start + (self._next[0] - self._first) / float(speed) - time.time())
+
+
+def _is_positive(setting):
+    """Return True if setting is a positive number"""
+
+    try:
+        return float(setting) > 0
+    except ValueError:
+        return False
+
+"""class EmonHubCaptureFile
+
+Appends the lines received by an interfacer to a capture file, rotated
+when it reaches max_size bytes, keeping 'files' files in all.
+
+The file starts with a signature, followed by a record per line: the time
+it was received at and its timestamp (0 if it had none) as doubles, its
+length as an unsigned short, and the line itself.
+
+"""
+
+
+class EmonHubCaptureFile(object):
+
+    signature = 'emonHub capture 1\n'
+    _record = struct.Struct('<ddH')
+
+    def __init__(self, path, max_size, files):
+        self._path = path
+        self._max_size = max_size
+        self._files = files
+        self._file = None
+        self._open()
+
+    def _open(self):
+        self._file = open(self._path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(self.signature)
+
+    def write(self, lines, arrival=None):
+        """Append lines, [(line, timestamp), ...], received at arrival (default now)"""
+
+        if arrival is None:
+            arrival = time.time()
+        record = self._record
+        self._file.write(''.join([record.pack(arrival, timestamp or 0.0, len(line[:0xffff])) + line[:0xffff]
+                                  for line, timestamp in lines]))
+        self._file.flush()
+        if self._file.tell() >= self._max_size:
+            self._rotate()
+
+    def _rotate(self):
+        """Rename path.N-1 to path.N, ..., path to path.1 and start a new file"""
+
+        self._file.close()
+        for i in xrange(self._files - 1, 0, -1):
+            source = self._path + ('.' + str(i - 1) if i > 1 else '')
+            if os.path.exists(source):
+                os.rename(source, self._path + '.' + str(i))
+        if self._files == 1:
+            os.remove(self._path)
+        self._open()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path):
+    """Read the lines saved in a capture file and its rotated copies, oldest first
+
+    Yield (time received, timestamp, line) tuples.
+
+    """
+
+    paths = []
+    i = 1
+    while os.path.exists(path + '.' + str(i)):
+        paths.insert(0, path + '.' + str(i))
+        i += 1
+    paths.append(path)
+
+    record = EmonHubCaptureFile._record
+    for name in paths:
+        with open(name, 'rb') as f:
+            if f.read(len(EmonHubCaptureFile.signature)) != EmonHubCaptureFile.signature:
+                logging.getLogger("EmonHub").warning("Not a capture file: " + name)
+                continue
+            while True:
+                header = f.read(record.size)
+                if len(header) < record.size:
+                    break
+                arrival, timestamp, length = record.unpack(header)
+                line = f.read(length)
+                if len(line) < length:
+                    # Cut short, eg. by a crash
+                    break
+                yield arrival, timestamp, line
+
+"""class EmonHubInterfacerProcess
+
+Runs an interfacer in a worker process, so that several interfacers read,
+process and decode their frames on several cores.
+
+The worker sends the frames back through a pipe, encoded with marshal (the
+fastest encoding, both ends running the same Python), together with its
+log records and statistics. The
+runtime settings, nodes settings and logging level are forwarded to it
+when they change. A worker that dies is restarted.
+
+"""
+
+
+class EmonHubInterfacerProcess(EmonHubInterfacer):
+
+    # Seconds to wait for a worker to start or stop
+    _start_timeout = 10
+    _stop_timeout = 5
+
+    # Seconds before restarting a worker that died
+    _restart_interval = 5
+
+    def __init__(self, name, interfacer_type, init_settings, runtimesettings):
+
+        # Initialization
+        super(EmonHubInterfacerProcess, self).__init__(name)
+
+        if interfacer_type not in globals() or interfacer_type == 'EmonHubInterfacerProcess':
+            raise EmonHubInterfacerInitError("Unknown interfacer type: " + interfacer_type)
+        self._type = interfacer_type
+        self._init_settings = dict(init_settings)
+        self._runtimesettings = dict(runtimesettings)
+
+        self._process = None
+        self._conn = None
+        self._restart_timestamp = 0
+        self._stats = {'received': 0, 'discarded': {}}
+        self._start()
+
+    def _start(self):
+        """Start the worker and wait until its interfacer is set up"""
+
+        self._conn, conn = multiprocessing.Pipe()
+        self._nodelist = ehc.nodelist
+        self._loglevel = self._log.getEffectiveLevel()
+        self._process = multiprocessing.Process(
+            target=_run_worker, name='emonhub-' + self.name,
+            args=(conn, self.name, self._type, self._init_settings, self._runtimesettings,
+                  self._nodelist, self._loglevel))
+        self._process.daemon = True
+        self._process.start()
+        conn.close()
+
+        error = "worker didn't start"
+        try:
+            while self._conn.poll(self._start_timeout):
+                data = self._conn.recv_bytes()
+                if data[0] == 'R':
+                    self._log.debug(self.name + " running in process " + str(self._process.pid))
+                    return
+                elif data[0] == 'E':
+                    error = data[1:]
+                    break
+                self._dispatch(data)
+        except EOFError:
+            error = "worker exited"
+        self._stop()
+        raise EmonHubInterfacerInitError(error)
+
+    def _stop(self):
+        """Ask the worker to close its interfacer, and wait for it to exit"""
+
+        try:
+            self._conn.send(('close',))
+        except (IOError, ValueError):
+            pass
+        self._process.join(self._stop_timeout)
+        if self._process.is_alive():
+            self._log.warning(self.name + " worker didn't exit, terminating it")
+            self._process.terminate()
+            self._process.join()
+        self._conn.close()
+        self._conn = None
+        self._process = None
+
+    def close(self):
+        """Stop the worker"""
+
+        if self._process is not None:
+            self._stop()
+
+    def read_batch(self):
+        """Return the frames received from the worker since last call"""
+
+        frames = []
+        if self._conn is None:
+            return frames
+        try:
+            # Bounded so that a busy worker doesn't starve the others
+            for i in xrange(100):
+                if not self._conn.poll():
+                    break
+                frames.extend(self._dispatch(self._conn.recv_bytes()))
+        except (EOFError, IOError):
+            self._stop()
+            self._log.error(self.name + " worker exited, restarting it in " +
+                            str(self._restart_interval) + " s")
+            self._restart_timestamp = time.time() + self._restart_interval
+        return frames
+
+    def _dispatch(self, data):
+        """Handle a message from the worker, return the frames it holds"""
+
+        kind = data[0]
+        if kind == 'F':
+            return marshal.loads(data[1:])
+        elif kind == 'L':
+            self._log.log(ord(data[1]), data[2:])
+        elif kind == 'S':
+            self._stats = json.loads(data[1:])
+        return []
+
+    def run(self):
+        """Restart the worker if it died, forward nodes and logging changes"""
+
+        if self._process is None:
+            if time.time() < self._restart_timestamp:
+                return
+            try:
+                self._start()
+            except EmonHubInterfacerInitError as e:
+                self._log.error("Failed to restart '" + self.name + "' interfacer: " + str(e))
+                self._restart_timestamp = time.time() + self._restart_interval
+            return
+
+        # set_nodelist() replaces the nodelist when the settings change
+        if ehc.nodelist is not self._nodelist:
+            self._nodelist = ehc.nodelist
+            self._send(('nodes', self._nodelist))
+        level = self._log.getEffectiveLevel()
+        if level != self._loglevel:
+            self._loglevel = level
+            self._send(('loglevel', level))
+
+    def _send(self, message):
+        """Send a message to the worker, it is restarted on failure by read_batch()"""
+
+        try:
+            self._conn.send(message)
+        except (IOError, ValueError) as e:
+            self._log.warning(self.name + " unable to reach worker: " + str(e))
+
+    def set(self, **kwargs):
+        """Forward the runtime settings to the worker"""
+
+        kwargs = dict(kwargs)
+        if kwargs != self._runtimesettings:
+            self._runtimesettings = kwargs
+            if self._process is not None:
+                self._send(('set', kwargs))
+
+    def get_stats(self):
+        """Return the statistics last sent by the worker"""
+
+        return self._stats
+
+    def get_fds(self):
+        """Return the pipe from the worker"""
+
+        return [self._conn] if self._conn is not None else []
+
+    def get_timeout(self):
+        """Return the number of seconds until the worker is restarted"""
+
+        if self._process is None:
+            return max(0, self._restart_timestamp - time.time())
+        return None
+
+
+"""class _PipeLogHandler
+
+Sends a worker's log records to the hub, which writes them to its log.
+
+"""
+
+
+class _PipeLogHandler(logging.Handler):
+
+    def __init__(self, conn):
+        logging.Handler.__init__(self)
+        self._conn = conn
+
+    def emit(self, record):
+        try:
+            self._conn.send_bytes('L' + chr(record.levelno) + self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def _close_inherited_fds(keep):
+    """Close the file descriptors inherited from the hub, but stdio and keep"""
+
+    keep = set(keep)
+    for stream in (sys.stdin, sys.stdout, sys.stderr):
+        try:
+            keep.add(stream.fileno())
+        except (AttributeError, ValueError):
+            pass
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _run_worker(conn, name, interfacer_type, init_settings, runtimesettings, nodes, loglevel):
+    """Run an interfacer in a worker process, see EmonHubInterfacerProcess"""
+
+    # The hub stops its workers on exit, Ctrl+C is for the hub only
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Don't keep the hub's sockets and files open (listening sockets, HTTP
+    # connections, other workers' pipes...), only the pipe to the hub
+    _close_inherited_fds([conn.fileno()])
+
+    # Forked while the hub's other threads (reporters, metrics server) may
+    # have held locks, which would then never be released: log through a
+    # new handler only, to the hub which owns the log file, and start the
+    # metrics over with a new lock
+    log = logging.getLogger("EmonHub")
+    log.handlers = [_PipeLogHandler(conn)]
+    log.propagate = False
+    log.setLevel(loglevel)
+    ehm.reinit_lock()
+
+    # Instrumentation is only collected in the hub process
+    ehm.configure('off', 0)
+
+    try:
+        I = globals()[interfacer_type](name, **init_settings)
+        I.set(**runtimesettings)
+    except Exception as e:
+        conn.send_bytes('E' + str(e))
+        return
+    ehc.set_nodelist(nodes)
+    conn.send_bytes('R')
+
+    stats = None
+    stats_timestamp = 0
+    try:
+        while True:
+            I.run()
+            frames = I.read_batch()
+            if frames:
+                conn.send_bytes('F' + marshal.dumps(frames))
+
+            # Send the statistics once a second if they changed
+            now = time.time()
+            if now - stats_timestamp >= 1:
+                stats_timestamp = now
+                if I.get_stats() != stats:
+                    stats = I.get_stats()
+                    conn.send_bytes('S' + json.dumps(stats))
+
+            # Wait for data, a task or a message from the hub
+            fds = I.get_fds()
+            timeout = I.get_timeout()
+            if not fds:
+                timeout = 0.2 if timeout is None else min(timeout, 0.2)
+            timeout = 1 if timeout is None else min(timeout, 1)
+            try:
+                select.select(fds + [conn], [], [], timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+            while conn.poll():
+                message = conn.recv()
+                if message[0] == 'set':
+                    I.set(**message[1])
+                elif message[0] == 'nodes':
+                    ehc.set_nodelist(message[1])
+                elif message[0] == 'loglevel':
+                    log.setLevel(message[1])
+                elif message[0] == 'close':
+                    return
+    except EOFError:
+        # The hub is gone
+        pass
+    except Exception as e:
+        if getattr(e, 'errno', None) != errno.EPIPE:
+            log.exception(name + " worker failed")
+    finally:
+        I.close()
 
 """class EmonHubInterfacerInitError
 
@@ -0,0 +1,237 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+import sys
+import time
+import types
+import errno
+import select
+import logging
+import traceback
+import collections
+
+"""class Wait
+
+Yielded by a task to sleep until one of the 'read' file descriptors (ints or
+objects with a fileno() method) is readable, one of the 'write' ones is
+writable, or timeout seconds have passed (None: no timeout).
+
+A task may be woken up early, eg. by a signal, and should check again what
+it was waiting for.
+
+"""
+
+
+class Wait(object):
+
+    __slots__ = ('read', 'write', 'deadline')
+
+    def __init__(self, read=(), write=(), timeout=None):
+        self.read = read
+        self.write = write
+        self.deadline = None if timeout is None else time.time() + timeout
+
+"""class Return
+
+Yielded by a generator called from a task to return a value to its caller
+(a generator can't 'return' a value in Python 2).
+
+"""
+
+
+class Return(object):
+
+    __slots__ = ('value',)
+
+    def __init__(self, value=None):
+        self.value = value
+
+"""class Task
+
+A generator run by the event loop, and the generators it called.
+
+"""
+
+
+class Task(object):
+
+    def __init__(self, generator, name, parent=None):
+        self.name = name
+        self.done = False
+        self.result = None
+        # Generators called and not yet returned, the innermost last
+        self._stack = [generator]
+        # Task waiting for this one, and tasks this one is waiting for
+        self._parent = parent
+        self._children = []
+        self._pending = 0
+
+"""class EmonHubEventLoop
+
+Runs tasks, which are generators, in a single thread.
+
+A task yields what it is waiting for and is resumed when it happens:
+- a Wait: until a file descriptor is ready or a timeout expires;
+- a generator: calls it, and resumes the task with the value the generator
+  yields as a Return, or with the exception it raised;
+- a list of generators: runs them as tasks at the same time, and resumes
+  the task with the list of their results (None for a failed one) once they
+  have all finished.
+
+Nothing runs while every task waits: the loop sleeps in poll() until the
+earliest file descriptor or timeout.
+
+"""
+
+
+class EmonHubEventLoop(object):
+
+    def __init__(self):
+
+        self._log = logging.getLogger("EmonHub")
+
+        # Tasks to resume, with the value to send or exception to throw
+        self._ready = collections.deque()
+        # Waiting tasks, with what they wait for
+        self._waiting = {}
+
+    def spawn(self, generator, name, parent=None):
+        """Schedule a generator to run as a task and return the task"""
+
+        task = Task(generator, name, parent)
+        self._ready.append((task, None, None))
+        return task
+
+    def cancel(self, task):
+        """Stop a task now, closing its generators (running their finally clauses)"""
+
+        if task.done:
+            return
+        task.done = True
+        self._waiting.pop(task, None)
+        for child in task._children:
+            self.cancel(child)
+        while task._stack:
+            try:
+                task._stack.pop().close()
+            except Exception:
+                self._log.error("Task " + task.name + " failed to close: " + traceback.format_exc())
+
+    def run(self, tasks):
+        """Run all the tasks until the given ones are done"""
+
+        while not all(task.done for task in tasks):
+            while self._ready:
+                task, value, error = self._ready.popleft()
+                if not task.done:
+                    self._step(task, value, error)
+            if all(task.done for task in tasks):
+                return
+            self._poll()
+
+    def _step(self, task, value, error):
+        """Resume a task until it waits for something or is done"""
+
+        stack = task._stack
+        while stack:
+            try:
+                if error is not None:
+                    result = stack[-1].throw(*error)
+                else:
+                    result = stack[-1].send(value)
+            except StopIteration:
+                stack.pop()
+                value, error = None, None
+                continue
+            except Exception:
+                stack.pop()
+                value, error = None, sys.exc_info()
+                continue
+            value, error = None, None
+
+            if isinstance(result, Wait):
+                self._waiting[task] = result
+                return
+            elif isinstance(result, types.GeneratorType):
+                stack.append(result)
+            elif isinstance(result, Return):
+                stack.pop().close()
+                value = result.value
+            elif isinstance(result, list):
+                if not result:
+                    value = []
+                    continue
+                task._children = [self.spawn(generator, task.name, task) for generator in result]
+                task._pending = len(result)
+                return
+            else:
+                error = (TypeError, TypeError("Task " + task.name + " yielded " + repr(result)), None)
+
+        task.done = True
+        if error is not None:
+            self._log.error("Task " + task.name + " failed: " +
+                            ''.join(traceback.format_exception(*error)))
+        else:
+            task.result = value
+
+        # Resume the parent once all its children are done
+        parent = task._parent
+        if parent is not None and not parent.done:
+            parent._pending -= 1
+            if not parent._pending:
+                results = [child.result for child in parent._children]
+                parent._children = []
+                self._ready.append((parent, results, None))
+
+    def _poll(self):
+        """Sleep until a waiting task's file descriptor is ready or timeout expires"""
+
+        if not self._waiting:
+            return
+
+        poller = select.poll()
+        masks = {}
+        tasks = collections.defaultdict(list)
+        deadline = None
+        for task, wait in self._waiting.iteritems():
+            for fds, mask in ((wait.read, select.POLLIN), (wait.write, select.POLLOUT)):
+                for fd in fds:
+                    if not isinstance(fd, (int, long)):
+                        fd = fd.fileno()
+                    masks[fd] = masks.get(fd, 0) | mask
+                    tasks[fd].append(task)
+            if wait.deadline is not None and (deadline is None or wait.deadline < deadline):
+                deadline = wait.deadline
+        for fd, mask in masks.iteritems():
+            poller.register(fd, mask)
+
+        if deadline is None:
+            timeout = None
+        else:
+            # In milliseconds, rounded up not to wake up just before the deadline
+            timeout = max(0, int((deadline - time.time()) * 1000 + 1))
+        try:
+            events = poller.poll(timeout)
+        except select.error as e:
+            # Interrupted by a signal (eg SIGINT), let every task check its state
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+            woken = self._waiting.keys()
+        else:
+            woken = set()
+            for fd, event in events:
+                woken.update(tasks[fd])
+            now = time.time()
+            woken.update(task for task, wait in self._waiting.iteritems()
+                         if wait.deadline is not None and wait.deadline <= now)
+
+        for task in woken:
+            del self._waiting[task]
+            self._ready.append((task, None, None))
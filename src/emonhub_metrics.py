@@ -0,0 +1,434 @@
+"""
+
+  This code is released under the GNU Affero General Public License.
+
+  OpenEnergyMonitor project:
+  http://openenergymonitor.org
+
+"""
+
+import math
+import time
+import json
+import socket
+import logging
+import threading
+import BaseHTTPServer
+
+# Instrumentation is off until switched on from the [hub] settings
+enabled = False
+
+# Seconds between two snapshots written to the log (0: never)
+log_interval = 0
+
+# Time the last snapshot was logged
+_log_timestamp = 0
+
+# Latency histograms and counters, by (owner name, stage or counter name)
+_histograms = {}
+_counters = {}
+
+# Guards the histograms and counters, updated from the reporter threads too
+_lock = threading.Lock()
+
+# Percentiles reported for each histogram
+percentiles = (50, 95, 99)
+
+
+def configure(state='off', interval=0):
+    """Switch instrumentation on or off
+
+    state (string): 'on' or 'off'
+    interval (string or number): seconds between two snapshots logged at
+        INFO level, 0 to disable the log
+
+    Statistics are reset when instrumentation is switched on.
+
+    Return True if the settings are valid.
+
+    """
+
+    global enabled, log_interval, _log_timestamp
+
+    state = str(state).lower()
+    try:
+        interval = float(interval)
+    except ValueError:
+        return False
+    if state not in ['on', 'off'] or interval < 0:
+        return False
+
+    if state == 'on' and not enabled:
+        reset()
+        _log_timestamp = time.time()
+    enabled = state == 'on'
+    log_interval = interval
+    return True
+
+
+def reinit_lock():
+    """Replace the lock, in a process forked while another thread may have held it"""
+
+    global _lock
+    _lock = threading.Lock()
+
+
+def reset():
+    """Clear all the statistics"""
+
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def start():
+    """Return the start time of a stage, None if instrumentation is off"""
+
+    if enabled:
+        return time.time()
+
+
+def record(owner, stage, started):
+    """Add the duration of a stage to its histogram
+
+    owner (string): interfacer, reporter or hub name
+    stage (string): name of the stage of the pipeline
+    started (float): as returned by start()
+
+    """
+
+    if started is None or not enabled:
+        return
+    duration = time.time() - started
+    with _lock:
+        h = _histograms.get((owner, stage))
+        if h is None:
+            h = _histograms[(owner, stage)] = Histogram()
+        h.add(duration)
+
+
+def count(owner, name, n=1):
+    """Add n to a counter, if instrumentation is on"""
+
+    if not enabled:
+        return
+    with _lock:
+        _counters[(owner, name)] = _counters.get((owner, name), 0) + n
+
+
+def snapshot():
+    """Return a copy of the statistics
+
+    Return a dict by owner name of {'stages': {stage: summary}, 'counters':
+    {name: value}}, summaries as returned by Histogram.summary()
+
+    """
+
+    stats = {}
+    with _lock:
+        for (owner, stage), h in _histograms.iteritems():
+            stats.setdefault(owner, {'stages': {}, 'counters': {}})['stages'][stage] = h.summary()
+        for (owner, name), value in _counters.iteritems():
+            stats.setdefault(owner, {'stages': {}, 'counters': {}})['counters'][name] = value
+    return stats
+
+
+def get_timeout():
+    """Return the number of seconds until the next snapshot is logged, or None"""
+
+    if not enabled or not log_interval:
+        return None
+    return max(0, _log_timestamp + log_interval - time.time())
+
+
+def run():
+    """Log a snapshot of the statistics if due"""
+
+    global _log_timestamp
+
+    if not enabled or not log_interval or time.time() - _log_timestamp < log_interval:
+        return
+    _log_timestamp = time.time()
+
+    log = logging.getLogger("EmonHub")
+    for owner, stats in sorted(snapshot().iteritems()):
+        for stage, s in sorted(stats['stages'].iteritems()):
+            log.info("Metrics " + owner + " " + stage + ": count=" + str(s['count']) +
+                     "".join(" p%d=%.3fms" % (p, s['p%d' % p] * 1000) for p in percentiles) +
+                     " max=%.3fms" % (s['max'] * 1000))
+        if stats['counters']:
+            log.info("Metrics " + owner + " counters: " +
+                     " ".join("%s=%s" % item for item in sorted(stats['counters'].iteritems())))
+
+
+def prometheus_text(metrics):
+    """Return the hub's metrics in the Prometheus text exposition format
+
+    metrics (dict): as returned by the hub's get_metrics()
+
+    """
+
+    lines = []
+
+    def family(name, kind, doc):
+        lines.append("# HELP emonhub_%s %s" % (name, doc))
+        lines.append("# TYPE emonhub_%s %s" % (name, kind))
+
+    def sample(name, labels, value):
+        lines.append("emonhub_%s{%s} %s" % (name, ",".join('%s="%s"' % (k, _escape(v))
+                                                            for k, v in labels), repr(float(value))))
+
+    def summary(name, labels, s):
+        for p in percentiles:
+            sample(name, labels + [('quantile', p / 100.0)], s['p%d' % p])
+        sample(name + "_sum", labels, s['total'])
+        sample(name + "_count", labels, s['count'])
+
+    interfacers = sorted(metrics['interfacers'].iteritems())
+    reporters = sorted(metrics['reporters'].iteritems())
+
+    family("frames_received_total", "counter", "Frames received by the interfacer")
+    for name, stats in interfacers:
+        sample("frames_received_total", [('interfacer', name)], stats['received'])
+    family("frames_discarded_total", "counter", "Frames discarded by the interfacer, by reason")
+    for name, stats in interfacers:
+        for reason, n in sorted(stats['discarded'].iteritems()):
+            sample("frames_discarded_total", [('interfacer', name), ('reason', reason)], n)
+    family("connection_frames_total", "counter", "Frames received on each open connection of the interfacer")
+    for name, stats in interfacers:
+        for peer, c in sorted(stats.get('connections', {}).iteritems()):
+            sample("connection_frames_total", [('interfacer', name), ('peer', peer)], c['frames'])
+    family("connection_received_bytes_total", "counter", "Bytes received on each open connection of the interfacer")
+    for name, stats in interfacers:
+        for peer, c in sorted(stats.get('connections', {}).iteritems()):
+            sample("connection_received_bytes_total", [('interfacer', name), ('peer', peer)], c['bytes'])
+    family("connection_discarded_total", "counter",
+           "Incomplete frames discarded on each open connection of the interfacer")
+    for name, stats in interfacers:
+        for peer, c in sorted(stats.get('connections', {}).iteritems()):
+            sample("connection_discarded_total", [('interfacer', name), ('peer', peer)], c['discarded'])
+    family("connection_since_seconds", "gauge", "Time each open connection of the interfacer was accepted")
+    for name, stats in interfacers:
+        for peer, c in sorted(stats.get('connections', {}).iteritems()):
+            sample("connection_since_seconds", [('interfacer', name), ('peer', peer)], c['since'])
+
+    family("reporter_queue_lag", "gauge", "Frames queued for the reporter, not yet buffered")
+    for name, stats in reporters:
+        sample("reporter_queue_lag", [('reporter', name)], stats['queue_lag'])
+    family("reporter_queue_overruns_total", "counter", "Frames lost as the reporter lagged behind the queue")
+    for name, stats in reporters:
+        sample("reporter_queue_overruns_total", [('reporter', name)], stats['queue_overruns'])
+    family("reporter_buffer_items", "gauge", "Items held in the reporter's buffer")
+    for name, stats in reporters:
+        sample("reporter_buffer_items", [('reporter', name)], stats['buffer_size'])
+    family("reporter_posts_total", "counter", "Posts sent by the reporter, by result")
+    for name, stats in reporters:
+        for result, n in sorted(stats['posts'].iteritems()):
+            sample("reporter_posts_total", [('reporter', name), ('result', result)], n)
+    family("reporter_post_latency_seconds", "summary", "Duration of the reporter's HTTP requests")
+    for name, stats in reporters:
+        summary("reporter_post_latency_seconds", [('reporter', name)], stats['post_latency'])
+    family("reporter_sent_bytes_total", "counter", "Bytes of data posted by the reporter")
+    for name, stats in reporters:
+        sample("reporter_sent_bytes_total", [('reporter', name)], stats['sent_bytes'])
+    family("reporter_batch_size", "gauge", "Items in the reporter's last batches")
+    for name, stats in reporters:
+        sample("reporter_batch_size", [('reporter', name)], stats['batch_size'])
+    family("reporter_drain_rate", "gauge", "Items per second deleted from the buffer by the last flush")
+    for name, stats in reporters:
+        sample("reporter_drain_rate", [('reporter', name)], stats['drain_rate'])
+    family("reporter_breaker_state", "gauge", "Reporter's circuit breaker state (1 for the current one)")
+    for name, stats in reporters:
+        for state in ['closed', 'open', 'half-open']:
+            sample("reporter_breaker_state", [('reporter', name), ('state', state)], stats['breaker'] == state)
+    family("reporter_breaker_opened_total", "counter", "Times the reporter's circuit breaker opened")
+    for name, stats in reporters:
+        sample("reporter_breaker_opened_total", [('reporter', name)], stats['breaker_opened'])
+    family("reporter_retry_seconds", "gauge", "Seconds until the reporter may post again")
+    for name, stats in reporters:
+        sample("reporter_retry_seconds", [('reporter', name)], stats['retry_in'])
+    family("reporter_aggregation_dropped_total", "counter",
+           "Frames dropped by the reporter's aggregation, late or not matching their window")
+    for name, stats in reporters:
+        sample("reporter_aggregation_dropped_total", [('reporter', name)], stats['aggregation_dropped'])
+    family("reporter_http_connections_total", "counter",
+           "HTTP connections opened, reused and reconnected, and server name resolutions")
+    for name, stats in reporters:
+        for event, n in sorted(stats['connections'].iteritems()):
+            sample("reporter_http_connections_total", [('reporter', name), ('event', event)], n)
+
+    if metrics['stages']:
+        family("stage_seconds", "summary", "Duration of each stage of the pipeline (instrumentation)")
+        for owner, stats in sorted(metrics['stages'].iteritems()):
+            for stage, s in sorted(stats['stages'].iteritems()):
+                summary("stage_seconds", [('name', owner), ('stage', stage)], s)
+        family("stage_events_total", "counter", "Pipeline counters (instrumentation)")
+        for owner, stats in sorted(metrics['stages'].iteritems()):
+            for counter, n in sorted(stats['counters'].iteritems()):
+                sample("stage_events_total", [('name', owner), ('event', counter)], n)
+
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    """Escape a Prometheus label value"""
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+"""class MetricsServer
+
+Serves the hub's metrics over HTTP from its own thread
+
+GET /metrics returns the Prometheus text format, GET /metrics.json the same
+metrics as JSON. Requests are handled one at a time, a client that stalls
+is dropped after a few seconds, so the hub and reporters are never held up.
+
+"""
+
+
+class MetricsServer(object):
+
+    # Seconds a client is given to send its request
+    _request_timeout = 5
+
+    def __init__(self, get_metrics, port, bind='127.0.0.1'):
+        """Start listening
+
+        get_metrics (function): returns the hub's metrics as a dict
+        port (int): TCP port to listen on
+        bind (string): address to listen on
+
+        """
+
+        self._log = logging.getLogger("EmonHub")
+        self._stop = False
+        self.address = (bind, int(port))
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            timeout = self._request_timeout
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/metrics':
+                    body = prometheus_text(get_metrics())
+                    ctype = 'text/plain; version=0.0.4'
+                elif path == '/metrics.json':
+                    body = json.dumps(get_metrics(), sort_keys=True)
+                    ctype = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server._log.debug("Metrics request from " + self.client_address[0] + ": " + format % args)
+
+        try:
+            self._server = BaseHTTPServer.HTTPServer(self.address, Handler)
+        except socket.error as e:
+            raise MetricsServerInitError("Could not listen on %s:%s: " % self.address + str(e))
+        self._thread = threading.Thread(target=self._serve, name="metrics")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        """Handle requests until closed, blocking while there are none"""
+
+        while not self._stop:
+            try:
+                self._server.handle_request()
+            except Exception as e:
+                self._log.warning("Metrics server error: " + str(e))
+        self._server.server_close()
+
+    def close(self):
+        """Stop listening"""
+
+        self._stop = True
+        # Wake the server up from waiting for a connection
+        host = self.address[0] if self.address[0] not in ['', '0.0.0.0'] else '127.0.0.1'
+        try:
+            socket.create_connection((host, self.address[1]), 1).close()
+        except socket.error:
+            pass
+        self._thread.join(self._request_timeout + 1)
+
+
+"""class MetricsServerInitError
+
+Raise this when the metrics server can't be started.
+
+"""
+
+
+class MetricsServerInitError(Exception):
+    pass
+
+
+"""class Histogram
+
+Latency histogram with logarithmic buckets
+
+Each power of two is split into 4 buckets, so a percentile is known to
+within 25% whatever the durations, with a fixed cost per sample.
+
+"""
+
+
+class Histogram(object):
+
+    # Buckets per power of two
+    _steps = 4
+
+    def __init__(self):
+
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = {}
+
+    def add(self, value):
+        """Add a duration (seconds)"""
+
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value > 0:
+            m, e = math.frexp(value)
+            bucket = e * self._steps + int((m - 0.5) * 2 * self._steps)
+        else:
+            bucket = None
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding the p-th percentile"""
+
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for bucket in sorted(self._buckets, key=lambda b: -1e9 if b is None else b):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                if bucket is None:
+                    return 0.0
+                e, step = divmod(bucket, self._steps)
+                return min(self.max, math.ldexp(0.5 + (step + 1) * 0.5 / self._steps, e))
+        return self.max
+
+    def summary(self):
+        """Return a dict of count, total, max and percentiles (seconds)"""
+
+        s = {'count': self.count, 'total': self.total, 'max': self.max}
+        for p in percentiles:
+            s['p%d' % p] = self.percentile(p)
+        return s
@@ -7,15 +7,27 @@
 
 """
 
-import urllib2
 import httplib
+import urlparse
+import socket
+import select
+import ssl
 import time
 import logging
 import json
+import zlib
+import random
 import threading
+import os
+import sys
+import errno
+import StringIO
 import Queue
 
 import emonhub_buffer as ehb
+import emonhub_coder as ehc
+import emonhub_metrics as ehm
+import emonhub_loop as ehl
   
 """class EmonHubReporter
 
@@ -29,8 +41,20 @@ destination server.
 
 class EmonHubReporter(threading.Thread):
 
+    # Consecutive failed flushes opening the circuit breaker
+    _breaker_threshold = 3
+
+    # First and longest wait (seconds) before probing a failing server
+    _backoff_min = 2
+    _backoff_max = 300
+
     def __init__(self, reporterName, queue, buffer_type="memory", buffer_size=1000, **kwargs):
-        """Create a server data buffer initialized with server settings."""
+        """Create a server data buffer initialized with server settings.
+
+        The reporter is run once set up, by start() in its own thread or as
+        run_async() by an event loop.
+
+        """
 
         # Initialize logger
         self._log = logging.getLogger("EmonHub")
@@ -41,7 +65,9 @@ class EmonHubReporter(threading.Thread):
         # Initialise settings
         self.name = reporterName
         self.init_settings = {}
-        self._defaults = {'pause': 'off', 'interval': '0', 'batchsize': '1'}
+        self._defaults = {'pause': 'off', 'interval': '0', 'batchsize': '1', 'timeout': '60', 'pipeline': '1',
+                          'adaptive': 'off', 'max_batchsize': '2500', 'max_payload': '500000',
+                          'aggregate': 'off', 'window': '60'}
         self._settings = {}
         self._queue = queue
 
@@ -53,6 +79,52 @@ class EmonHubReporter(threading.Thread):
         # Initialize interval timer's "started at" timestamp
         self._interval_timestamp = 0
 
+        # Earliest time to retry after a failed flush
+        self._retry_interval = 0.1
+        self._retry_timestamp = 0
+
+        # Circuit breaker: 'closed' (posting), 'open' (waiting until the retry
+        # time) or 'half-open' (probing the server), consecutive failed
+        # flushes, times opened in a row and in total
+        self._breaker = 'closed'
+        self._failures = 0
+        self._backoff_count = 0
+        self._breaker_opened = 0
+
+        # Number of successful and failed posts, latency of the HTTP requests
+        self._posts = {'success': 0, 'failure': 0}
+        self._post_latency = ehm.Histogram()
+        self._stats_lock = threading.Lock()
+
+        # Persistent connections to the server
+        self._http = EmonHubHTTPConnectionPool(reporterName)
+
+        # Threads posting the batches other than the first, started as the
+        # pipeline needs them, fed (batch position, batch, results queue)
+        self._post_workers = []
+        self._post_tasks = Queue.Queue()
+
+        # Items posted and acknowledged but still in the buffer as older
+        # items failed, by position from the oldest item
+        self._acked = {}
+
+        # Adaptive batch sizing: current size, smoothed post latency (s), body
+        # bytes sent, size of an item once encoded, outcome and drain rate
+        # (items/s) of the last flush
+        self._batch_size = 0
+        self._latency = 0.0
+        self._sent_bytes = 0
+        self._item_bytes = 0.0
+        self._flush_failed = False
+        self._drain_rate = 0.0
+
+        # Per node aggregation of the frames, when on for the reporter or a
+        # node, frames it dropped, and nodes settings last checked
+        self._aggregator = None
+        self._aggregation_dropped = 0
+        self._nodelist = None
+        self._nodes_aggregate = False
+
         # Create underlying buffer implementation
         self.buffer = ehb.getBuffer(buffer_type)(reporterName, buffer_size, **kwargs)
 
@@ -64,9 +136,8 @@ class EmonHubReporter(threading.Thread):
         self._log.info("Set up reporter '%s' (buffer: %s | size: %s)"
                        % (reporterName, buffer_type, buffer_size))
 
-        # Initialise a thread and start the reporter
+        # Initialise a thread, started once the subclass is set up
         self.stop = False
-        self.start()
         
     def set(self, **kwargs):
         """Update settings.
@@ -80,6 +151,13 @@ class EmonHubReporter(threading.Thread):
             'pause' = in   pauses the input only, no add to buffer but flush still functional
             'pause' = out  pauses output only, no flush but data can accumulate in buffer
             'pause' = off  pause is off and reporter is fully operational
+        timeout (string): seconds to wait for the server's reply
+        pipeline (string): number of batches posted at the same time
+        adaptive (string): 'on' to size the batches from the backlog, between
+            batchsize and max_batchsize items and up to max_payload bytes
+        aggregate (string): 'mean', 'min', 'max', 'last' or 'sum' to buffer
+            one frame per node every 'window' seconds, 'off' to buffer them all
+        window (string): aggregation window in seconds
         
         """
 
@@ -92,34 +170,26 @@ class EmonHubReporter(threading.Thread):
                 continue
             elif key == 'pause' and str(setting).lower() in ['all', 'in', 'out', 'off']:
                 pass
-            elif key in ['interval', 'batchsize'] and setting.isdigit():
+            elif key in ['interval', 'batchsize'] and str(setting).isdigit():
+                pass
+            elif key in ['timeout', 'pipeline', 'max_batchsize', 'max_payload', 'window'] \
+                    and str(setting).isdigit() and int(setting) > 0:
+                pass
+            elif key == 'adaptive' and str(setting).lower() in ['on', 'off']:
+                pass
+            elif key == 'aggregate' and str(setting).lower() in ['off'] + EmonHubAggregator.functions:
                 pass
             else:
                 self._log.warning("'%s' is not a valid setting for %s: %s" % (setting, self.name, key))
+                continue
             self._settings[key] = setting
             self._log.debug("Setting " + self.name + " " + key + ": " + str(setting))
 
-        for key, setting in self._defaults.iteritems():
-            valid = False
-            if key in kwargs.keys():
-                setting = kwargs[key]
-            else:
-                setting = self._defaults[key]
-            if key in self._settings and self._settings[key] == setting:
-                continue
-            elif key == 'pause':
-                if str(setting).lower() in ['all', 'in', 'out', 'off']:
-                    valid = True
-            elif key == 'interval' or 'batchsize':
-                if setting.isdigit():
-                    valid = True
-            else:
-                continue
-            if valid:
-                self._settings[key] = setting
-                self._log.debug("Setting " + self.name + " " + key + ": " + str(setting))
-            else:
-                self._log.warning("'%s' is not a valid setting for %s: %s" % (setting, self.name, key))
+        # Keep a connection open for each batch in flight
+        self._http.max_idle = max(EmonHubHTTPConnectionPool.max_idle, int(self._settings['pipeline']))
+
+        # Let the thread re-evaluate when the buffer is next due to be flushed
+        self._queue.wake()
 
     def add(self, data):
         """Append data to buffer.
@@ -139,77 +209,528 @@ class EmonHubReporter(threading.Thread):
         # databuffer is of format:
         # [[timestamp, nodeid, datavalues][timestamp, nodeid, datavalues]]
         # [[1399980731, 10, 150, 3450 ...]]
-        self.buffer.storeItem(data)
+        for item in self._aggregate([data]):
+            self.buffer.storeItem(item)
+
+    def add_batch(self, frames):
+        """Append a batch of data to buffer in one operation.
+
+        frames (list): list of frames as passed to add()
+
+        """
+
+        if self._log.isEnabledFor(logging.DEBUG):
+            for data in frames:
+                self._log.debug(str(data[-1]) + " Append to '" + self.name +
+                                "' buffer => time: " + str(data[0])
+                                + ", data: " + str(data[1:-1])
+                                + ", ref: " + str(data[-1]))
+
+        # "ref" removed from end of each frame so not sent to emoncms
+        started = ehm.start()
+        items = self._aggregate([data[:-1] for data in frames])
+        if items:
+            self.buffer.storeItems(items)
+        ehm.record(self.name, 'store', started)
+        ehm.count(self.name, 'frames', len(frames))
 
     def run(self):
         """
         Run the reporter thread.
         Any regularly performed tasks actioned here along with flushing the buffer
 
+        The thread sleeps until new frames are queued or the buffer is next
+        due to be flushed.
+
         """
         while not self.stop:
-            # If there are frames in the queue
-            while not self._queue.empty():
-                # Add each frame to the buffer
-                frame = self._queue.get()
-                self.add(frame)
-            # Don't loop to fast
-            time.sleep(0.1)
+            # Get all new frames from the queue, waiting for some if nothing to do
+            frames = self._queue.get(self._get_timeout())
+            # discard if 'pause' set to 'all' or 'in'
+            if frames and str(self._settings['pause']).lower() not in ['all', 'in']:
+                # Add all frames to the buffer
+                self.add_batch(frames)
+            # Add the frames of the aggregation windows that are over
+            self._close_windows()
+            # Commit the buffer's writes due to be
+            self.buffer.sync()
             # Action reporter tasks
             self.action()
 
+        # Write out anything the buffer still holds
+        self._close_windows(True)
+        self.buffer.close()
+        self._stop_post_workers()
+        self._http.close()
+
+    def run_async(self):
+        """Run the reporter as an ehl.EmonHubEventLoop task instead of a thread
+
+        Same as run(), with non-blocking posts.
+
+        """
+
+        try:
+            while not self.stop:
+                frames = self._queue.get()
+                if frames and str(self._settings['pause']).lower() not in ['all', 'in']:
+                    self.add_batch(frames)
+                self._close_windows()
+                self.buffer.sync()
+                if self._flush_due():
+                    self._flushed((yield self.flush_async()))
+                # Wait for new frames unless some came in meanwhile
+                if not self.stop and self._queue.arm():
+                    yield ehl.Wait([self._queue], timeout=self._get_timeout())
+                    self._queue.waiting = False
+                    self._queue.wait(0)
+        finally:
+            self._close_windows(True)
+            self.buffer.close()
+            self._http.close()
+
+    def _get_timeout(self):
+        """Return the number of seconds until the buffer is next due to be flushed
+        or synced, or an aggregation window to be closed.
+
+        None means there is nothing to do until new frames are queued.
+
+        """
+
+        timeouts = [self.buffer.getSyncTimeout()]
+        if self._aggregator is not None:
+            timeouts.append(self._aggregator.get_timeout())
+
+        if str(self._settings['pause']).lower() not in ['all', 'out'] \
+                and self.buffer.hasItems() and self._can_post():
+            due = max(self._interval_timestamp + int(self._settings['interval']),
+                      self._retry_timestamp)
+            timeouts.append(max(0, due - time.time()))
+
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def _aggregate(self, items):
+        """Return the items to buffer: items as they are if aggregation is off
+        for the reporter and all the nodes, else the aggregates of the windows
+        they closed
+
+        The aggregator is replaced here, in the reporter's thread, when the
+        settings change.
+
+        """
+
+        aggregate = str(self._settings['aggregate']).lower()
+        window = int(self._settings['window'])
+        if aggregate == 'off' and not self._nodes_aggregated():
+            aggregate = None
+
+        stored = []
+        aggregator = self._aggregator
+        closed = None
+        if aggregator is not None and (aggregator.aggregate, aggregator.window) != (aggregate, window):
+            # Keep what was aggregated with the former settings, and which
+            # windows were, not to aggregate them again
+            stored = aggregator.close()
+            closed = aggregator.closed
+            self._aggregation_dropped += aggregator.dropped
+            aggregator = self._aggregator = None
+        if aggregate is None:
+            return stored + items
+        if aggregator is None:
+            aggregator = self._aggregator = EmonHubAggregator(aggregate, window, closed)
+            if aggregate == 'off':
+                self._log.info(self.name + " aggregating the frames of the nodes with an aggregate setting in [nodes]")
+            else:
+                self._log.info(self.name + " aggregating frames: " + aggregate + " every " + str(window) + " s")
+        return stored + aggregator.add(items) + aggregator.expire()
+
+    def _nodes_aggregated(self):
+        """Return True if a node in [nodes] sets its frames to be aggregated"""
+
+        # set_nodelist() replaces the nodelist when the settings change
+        if ehc.nodelist is not self._nodelist:
+            self._nodelist = ehc.nodelist
+            self._nodes_aggregate = any(str(settings.get('aggregate', 'off')).lower() != 'off'
+                                        for settings in self._nodelist.itervalues())
+        return self._nodes_aggregate
+
+    def _close_windows(self, everything=False):
+        """Buffer the aggregates of the windows that are over, or of all of them"""
+
+        if self._aggregator is None:
+            return
+        items = self._aggregator.close() if everything else self._aggregate([])
+        if items:
+            self.buffer.storeItems(items)
+
     def action(self):
         """
 
         :return:
         """
 
+        if self._flush_due():
+            self._flushed(self.flush())
+
+    def _flush_due(self):
+        """Return True if the buffer is to be flushed now"""
+
         # pause output if 'pause' set to 'all' or 'out'
         if 'pause' in self._settings \
                 and str(self._settings['pause']).lower() in ['all', 'out']:
-            return
+            return False
 
         # If an interval is set, check if that time has passed since last post
         if int(self._settings['interval']) \
                 and time.time() - self._interval_timestamp < int(self._settings['interval']):
-            return
-        else:
-            # Then attempt to flush the buffer
-            self.flush()
+            return False
+        elif time.time() < self._retry_timestamp:
+            # Nothing is retrieved or encoded while the circuit breaker is open
+            return False
+        # Not a failed post: wait for the settings to be corrected
+        return self._can_post()
+
+    def _can_post(self):
+        """
+        To be overridden in subclass.
+
+        :return: True if the settings allow posting
+        """
+        return True
+
+    def _flushed(self, success):
+        """Wait a little before retrying if the flush failed"""
+
+        if not success and self.buffer.hasItems():
+            self._retry_timestamp = max(self._retry_timestamp, time.time() + self._retry_interval)
 
     def flush(self):
-        """Send oldest data in buffer, if any."""
+        """Send oldest data in buffer, if any.
+
+        Up to 'pipeline' batches are posted at the same time. Acknowledged
+        batches are deleted from the buffer in order: a batch acknowledged
+        while an older one failed is kept until that one is sent, and
+        remembered so that it is not sent again.
+
+        Return True if data was sent.
+
+        """
         
         # Buffer management
         # If data buffer not empty, send a set of values
-        if self.buffer.hasItems():
-            max_items = int(self._settings['batchsize'])
-            if max_items > self._item_limit:
-                max_items = self._item_limit
-            elif max_items <= 0:
+        flush = self._start_flush()
+        if flush:
+            databuffer, batches = flush[:2]
+            results = self._post_batches([[databuffer[pos] for pos in batch] for batch in batches])
+            return self._end_flush(flush, results)
+
+    def flush_async(self):
+        """Flush the buffer as flush() does, without blocking
+
+        To be run by an ehl.EmonHubEventLoop task, the batches are posted
+        by concurrent tasks. Yields the result as an ehl.Return.
+
+        """
+
+        flush = self._start_flush()
+        if not flush:
+            yield ehl.Return()
+        databuffer, batches = flush[:2]
+        results = yield [self._process_post_async([databuffer[pos] for pos in batch]) for batch in batches]
+        yield ehl.Return(self._end_flush(flush, results))
+
+    def _start_flush(self):
+        """Retrieve the items to post and split them into batches
+
+        Return (items retrieved, batches of positions in the items, time
+        started, bytes sent so far), or None if there is nothing to post
+
+        """
+
+        if not self.buffer.hasItems():
+            return None
+        max_items = self._get_batch_size()
+        if max_items <= 0:
+            return None
+        pipeline = int(self._settings['pipeline'])
+        if self._breaker == 'open':
+            # Probe the server with a single item
+            self._breaker = 'half-open'
+            self._log.info(self.name + " circuit breaker half-open, probing server")
+        if self._breaker == 'half-open':
+            max_items = pipeline = 1
+        started = time.time()
+        sent_bytes = self._sent_bytes
+
+        # Up to the newest item acknowledged, which the batches may have shrunk under
+        acked = max(self._acked) + 1 if self._acked else 0
+        databuffer = self.buffer.retrieveItems(acked + max_items * pipeline)
+        self._check_acked(databuffer)
+
+        # Split the items not yet acknowledged into batches, by position
+        batches = [[]]
+        for pos in xrange(len(databuffer)):
+            if pos in self._acked:
+                continue
+            if len(batches[-1]) == max_items:
+                if len(batches) == pipeline:
+                    break
+                batches.append([])
+            batches[-1].append(pos)
+        return databuffer, batches, started, sent_bytes
+
+    def _end_flush(self, flush, results):
+        """Delete the acknowledged items from the buffer
+
+        flush: as returned by _start_flush()
+        results: result of each batch's post
+
+        Return True if all the batches were sent.
+
+        """
+
+        databuffer, batches, started, sent_bytes = flush
+        for batch, result in zip(batches, results):
+            if result:
+                for pos in batch:
+                    self._acked[pos] = databuffer[pos]
+                ehm.count(self.name, 'posted', len(batch))
+                self._posts['success'] += 1
+            else:
+                ehm.count(self.name, 'post_failures')
+                self._posts['failure'] += 1
+
+        # Delete the acknowledged items at the head of the buffer
+        sent = 0
+        while sent in self._acked:
+            sent += 1
+        if sent:
+            self.buffer.discardLastRetrievedItems(sent)
+            self._acked = dict((pos - sent, item) for pos, item in self._acked.iteritems() if pos >= sent)
+
+        self._update_breaker(any(results))
+
+        # Measure what the next batches can be sized from
+        self._flush_failed = not all(results)
+        self._drain_rate = sent / max(time.time() - started, 1e-3)
+        if not self._flush_failed and self._sent_bytes > sent_bytes:
+            self._item_bytes = float(self._sent_bytes - sent_bytes) / sum(len(batch) for batch in batches)
+
+        if any(results):
+            # log the time of last succesful post
+            self._interval_timestamp = time.time()
+        return all(results)
+
+    def _update_breaker(self, success):
+        """Open the circuit breaker after repeated failures, close it on success
+
+        While open, nothing is posted until the retry time: the wait doubles
+        each time the breaker opens again, from _backoff_min up to
+        _backoff_max seconds, with a random part so that hubs don't all
+        retry at the same time.
+
+        """
+
+        if success:
+            if self._breaker != 'closed':
+                self._log.info(self.name + " circuit breaker closed after " + str(self._failures) +
+                               " failed posts")
+            self._breaker = 'closed'
+            self._failures = 0
+            self._backoff_count = 0
+            return
+
+        self._failures += 1
+        if self._breaker == 'closed' and self._failures < self._breaker_threshold:
+            return
+
+        delay = min(self._backoff_max, self._backoff_min * 2 ** self._backoff_count)
+        delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+        self._backoff_count += 1
+        self._retry_timestamp = time.time() + delay
+        if self._breaker == 'closed':
+            self._breaker_opened += 1
+        self._breaker = 'open'
+        self._log.warning(self.name + " circuit breaker open after " + str(self._failures) +
+                          " failed posts, next attempt in %.1f s" % delay)
+
+    def _get_batch_size(self):
+        """Return the number of items to post in each batch
+
+        With 'adaptive' on, the batches are doubled while a backlog drains
+        and the server replies within an eighth of the timeout, halved when
+        it takes more than a quarter of the timeout or a post fails, and
+        left as they are in between. They are kept under max_batchsize items
+        and max_payload bytes, and back to batchsize once the backlog is
+        cleared.
+
+        """
+
+        # number of items posted is the lower of the item limit, buffer_size, or the batchsize
+        max_items = int(self._settings['batchsize'])
+        if str(self._settings['adaptive']).lower() != 'on' or max_items <= 0:
+            self._batch_size = min(max_items, self._item_limit)
+            return self._batch_size
+
+        backlog = self.buffer.size()
+        size = self._batch_size or max_items
+        if backlog <= max_items:
+            # Caught up, back to small frequent posts
+            size = max_items
+        else:
+            target = int(self._settings['timeout']) / 4.0
+            if self._flush_failed or self._latency > target:
+                size = size / 2
+            elif self._latency < target / 2:
+                size = size * 2
+            limit = int(self._settings['max_batchsize'])
+            if self._item_bytes:
+                limit = min(limit, int(int(self._settings['max_payload']) / self._item_bytes))
+            size = max(max_items, min(size, limit))
+
+        if size != self._batch_size and self._batch_size:
+            self._log.info(self.name + " batch size " + str(self._batch_size) + " -> " + str(size) +
+                           " (backlog: " + str(backlog) + " items, latency: %.2f s, %.0f bytes/item, "
+                           "draining %.0f items/s)" % (self._latency, self._item_bytes, self._drain_rate))
+        self._batch_size = size
+        return size
+
+    def _post_batches(self, batches):
+        """Post the batches concurrently, the first one from the calling thread
+
+        Return the result of _process_post() for each batch, in order
+
+        """
+
+        results = [None] * len(batches)
+        done = Queue.Queue()
+        while len(self._post_workers) < len(batches) - 1:
+            worker = threading.Thread(target=self._post_worker, name=self.name + " post")
+            worker.daemon = True
+            worker.start()
+            self._post_workers.append(worker)
+        for i in xrange(1, len(batches)):
+            self._post_tasks.put((i, batches[i], done))
+        results[0] = self._process_post(batches[0])
+        for i in xrange(1, len(batches)):
+            pos, result = done.get()
+            results[pos] = result
+        return results
+
+    def _post_worker(self):
+        """Post the batches queued by _post_batches() until given None"""
+
+        while True:
+            task = self._post_tasks.get()
+            if task is None:
+                return
+            pos, batch, done = task
+            try:
+                result = self._process_post(batch)
+            except Exception:
+                self._log.exception(self.name + " unable to post batch")
+                result = None
+            done.put((pos, result))
+
+    def _stop_post_workers(self):
+        """Stop the threads posting batches"""
+
+        for worker in self._post_workers:
+            self._post_tasks.put(None)
+        for worker in self._post_workers:
+            worker.join()
+        self._post_workers = []
+
+    def _check_acked(self, databuffer):
+        """Forget the acknowledged items if the buffer changed under them
+
+        The buffer may have dropped its oldest items when full.
+
+        """
+
+        for pos, item in self._acked.iteritems():
+            if pos >= len(databuffer) or databuffer[pos] != item:
+                self._log.warning(self.name + " buffer changed while waiting to delete acknowledged data, " +
+                                  str(len(self._acked)) + " items may be sent again")
+                self._acked = {}
                 return
 
-            databuffer = self.buffer.retrieveItems(max_items)
-            retrievedlength = len(databuffer)
-            if self._process_post(databuffer):
-                # In case of success, delete sample set from buffer
-                self.buffer.discardLastRetrievedItems(retrievedlength)
-                # log the time of last succesful post
-                self._interval_timestamp = time.time()
+    def get_stats(self):
+        """Return the reporter's backlog and post statistics
+
+        Return a dict: {'queue_lag': frames not yet read from the hub's queue,
+        'queue_overruns': frames lost from the queue, 'buffer_size': items
+        waiting to be sent, 'posts': {'success': n, 'failure': n},
+        'post_latency': as returned by ehm.Histogram.summary(),
+        'connections': as returned by EmonHubHTTPConnectionPool.get_stats(),
+        'sent_bytes': bytes posted, 'batch_size': items in the last batches,
+        'drain_rate': items/s deleted from the buffer by the last flush,
+        'breaker': circuit breaker state, 'breaker_opened': times it opened,
+        'retry_in': seconds until the next post is allowed,
+        'aggregation_dropped': frames dropped by the aggregation}
+
+        """
+
+        with self._stats_lock:
+            latency = self._post_latency.summary()
+        aggregator = self._aggregator
+        return {'queue_lag': self._queue.lag(), 'queue_overruns': self._queue.overruns,
+                'buffer_size': self.buffer.size(), 'posts': dict(self._posts),
+                'post_latency': latency, 'connections': self._http.get_stats(),
+                'sent_bytes': self._sent_bytes, 'batch_size': self._batch_size,
+                'drain_rate': self._drain_rate, 'breaker': self._breaker,
+                'breaker_opened': self._breaker_opened,
+                'retry_in': max(0, self._retry_timestamp - time.time()),
+                'aggregation_dropped': self._aggregation_dropped + (aggregator.dropped if aggregator else 0)}
 
     def _process_post(self, data):
+        """Encode the data, send it and check the reply
+
+        :return: True if data posted successfully and can be discarded
+        """
+
+        post = self._encode_post(data)
+        if post is None:
+            return
+        return self._check_reply(self._send_post(*post))
+
+    def _process_post_async(self, data):
+        """Post the data as _process_post() does, without blocking
+
+        Yields the result as an ehl.Return.
+
+        """
+
+        post = self._encode_post(data)
+        if post is None:
+            yield ehl.Return()
+        reply = yield self._send_post_async(*post)
+        yield ehl.Return(self._check_reply(reply))
+
+    def _encode_post(self, data):
         """
         To be implemented in subclass.
 
-        :return: True if data posted successfully and can be discarded
+        :return: the url, body and extra headers (dict or None) of the post,
+            None if the data can't be sent
+        """
+        pass
+
+    def _check_reply(self, reply):
+        """
+        To be implemented in subclass.
+
+        :return: True if the reply acknowledges the data
         """
         pass
 
-    def _send_post(self, post_url, post_body=None):
+    def _send_post(self, post_url, post_body=None, headers=None):
         """
 
         :param post_url:
         :param post_body:
+        :param headers: extra request headers (dict)
         :return: the received reply if request is successful
         """
         """Send data to server.
@@ -222,25 +743,69 @@ class EmonHubReporter(threading.Thread):
         """
 
         reply = ""
-        request = urllib2.Request(post_url, post_body)
+        started = time.time()
+        try:
+            status, reason, data = self._http.request(post_url, post_body, int(self._settings['timeout']),
+                                                      headers)
+        except Exception as e:
+            self._log_send_error(e)
+        else:
+            reply = self._get_reply(status, data)
+        finally:
+            self._record_post(started, post_body)
+            return reply
+
+    def _send_post_async(self, post_url, post_body=None, headers=None):
+        """Send data to server as _send_post() does, without blocking
+
+        Yields the received reply as an ehl.Return.
+
+        """
+
+        reply = ""
+        started = time.time()
         try:
-            response = urllib2.urlopen(request, timeout=60)
-        except urllib2.HTTPError as e:
-            self._log.warning(self.name + " couldn't send to server, HTTPError: " +
-                              str(e.code))
-        except urllib2.URLError as e:
+            status, reason, data = yield self._http.request_async(post_url, post_body,
+                                                                  int(self._settings['timeout']), headers)
+        except Exception as e:
+            self._log_send_error(e)
+        else:
+            reply = self._get_reply(status, data)
+        self._record_post(started, post_body)
+        yield ehl.Return(reply)
+
+    def _log_send_error(self, e):
+        """Log why a request failed"""
+
+        if isinstance(e, socket.error):
+            # Includes name resolution errors and timeouts
             self._log.warning(self.name + " couldn't send to server, URLError: " +
-                              str(e.reason))
-        except httplib.HTTPException:
+                              str(e))
+        elif isinstance(e, httplib.HTTPException):
             self._log.warning(self.name + " couldn't send to server, HTTPException")
-        except Exception:
+        else:
             import traceback
             self._log.warning(self.name + " couldn't send to server, Exception: " +
                               traceback.format_exc())
-        else:
-            reply = response.read()
-        finally:
-            return reply
+
+    def _get_reply(self, status, data):
+        """Return the content of a successful reply, "" otherwise"""
+
+        if 200 <= status < 300:
+            return data
+        self._log.warning(self.name + " couldn't send to server, HTTPError: " +
+                          str(status))
+        return ""
+
+    def _record_post(self, started, post_body):
+        """Record the latency and size of a post"""
+
+        ehm.record(self.name, 'send', started)
+        latency = time.time() - started
+        with self._stats_lock:
+            self._post_latency.add(latency)
+            self._latency = 0.7 * self._latency + 0.3 * latency if self._latency else latency
+            self._sent_bytes += len(post_body or '')
 
 """class EmonHubEmoncmsReporter
 
@@ -261,7 +826,7 @@ class EmonHubEmoncmsReporter(EmonHubReporter):
 
         # add or alter any default settings for this reporter
         self._defaults.update({'batchsize': 100})
-        self._cms_settings = {'apikey': "", 'url': 'http://emoncms.org'}
+        self._cms_settings = {'apikey': "", 'url': 'http://emoncms.org', 'compact': 'off', 'gzip': 'off'}
 
         # This line will stop the default values printing to logfile at start-up
         self._settings.update(self._defaults)
@@ -269,6 +834,9 @@ class EmonHubEmoncmsReporter(EmonHubReporter):
         # set an absolute upper limit for number of items to process per post
         self._item_limit = 250
 
+        # Whether the missing apikey has been logged since last valid
+        self._apikey_logged = False
+
     def set(self, **kwargs):
         """
 
@@ -307,36 +875,65 @@ class EmonHubEmoncmsReporter(EmonHubReporter):
                 self._log.info("Setting " + self.name + " url: " + setting)
                 self._settings[key] = setting
                 continue
+            elif key in ['compact', 'gzip'] and str(setting).lower() in ['on', 'off']:
+                self._log.info("Setting " + self.name + " " + key + ": " + setting)
+                self._settings[key] = setting
+                continue
             else:
                 self._log.warning("'%s' is not valid for %s: %s" % (setting, self.name, key))
 
-    def _process_post(self, databuffer):
-        """Send data to server."""
+        # Let the thread post the data held for a missing apikey
+        self._queue.wake()
+
+    def _has_apikey(self):
+        """Return True if a valid apikey is set"""
+
+        return 'apikey' in self._settings.keys() and str.__len__(self._settings['apikey']) == 32 \
+            and str.lower(self._settings['apikey']) != 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+
+    def _can_post(self):
+        """Return True if a valid apikey is set, log once that data is held otherwise"""
+
+        if self._has_apikey():
+            self._apikey_logged = False
+            return True
+        if not getattr(self, '_apikey_logged', False):
+            self._log.warning(self.name + " has no valid apikey, data is kept in the buffer until one is set")
+            self._apikey_logged = True
+        return False
+
+    def _encode_post(self, databuffer):
+        """Return the url, body and headers of the post sending databuffer"""
         
         # databuffer is of format:
         # [[timestamp, nodeid, datavalues][timestamp, nodeid, datavalues]]
         # [[1399980731, 10, 150, 250 ...]]
 
-        if not 'apikey' in self._settings.keys() or str.__len__(self._settings['apikey']) != 32 \
-                or str.lower(self._settings['apikey']) == 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx':
+        if not self._has_apikey():
             return
 
-        data_string = json.dumps(databuffer, separators=(',', ':'))
+        # time that the request was sent at
+        sentat = int(time.time())
+
+        started = ehm.start()
+        if str(self._settings.get('compact')).lower() == 'on':
+            data_string, sentat = self._encode_compact(databuffer, sentat)
+        else:
+            data_string = json.dumps(databuffer, separators=(',', ':'))
+        ehm.record(self.name, 'encode', started)
         
         # Prepare URL string of the form
         # http://domain.tld/emoncms/input/bulk.json?apikey=12345
         # &data=[[0,10,82,23],[5,10,82,23],[10,10,82,23]]
         # &sentat=15' (requires emoncms >= 8.0)
 
-        # time that the request was sent at
-        sentat = int(time.time())
-
         # Construct post_url (without apikey)
         post_url = self._settings['url']+'/input/bulk'+'.json?apikey='
         post_body = "data="+data_string+"&sentat="+str(sentat)
 
         # logged before apikey added for security
-        self._log.info(self.name + " sending: " + post_url + "E-M-O-N-C-M-S-A-P-I-K-E-Y&" + post_body)
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug(self.name + " sending: " + post_url + "E-M-O-N-C-M-S-A-P-I-K-E-Y&" + post_body)
 
         # Add apikey to post_url
         post_url = post_url + self._settings['apikey']
@@ -345,13 +942,718 @@ class EmonHubEmoncmsReporter(EmonHubReporter):
         # body, this should be moved from the url to the body as soon as this is widely
         # adopted
 
-        reply = self._send_post(post_url, post_body)
+        headers = None
+        if str(self._settings.get('gzip')).lower() == 'on':
+            post_body = _gzip(post_body)
+            headers = {'Content-Encoding': 'gzip'}
+
+        return post_url, post_body, headers
+
+    def _check_reply(self, reply):
+        """Return True if emoncms acknowledged the data"""
+
         if reply == 'ok':
             self._log.debug(self.name + " acknowledged receipt with '" + reply + "' from " + self._settings['url'])
             return True
         else:
             self._log.warning(self.name + " send failure: wanted 'ok' but got '" +reply+ "'")
 
+    def _encode_compact(self, databuffer, sentat):
+        """Encode the data with timestamps relative to the oldest one
+
+        emoncms takes each row's timestamp as an offset from the time the
+        request was sent at (sentat), in whole seconds, so shifting both by
+        the same base gives the same times with shorter numbers. Integral
+        floats are sent as integers.
+
+        Return the JSON encoded data and the shifted sentat
+
+        """
+
+        base = int(databuffer[0][0])
+        rows = [[int(row[0]) - base] +
+                [int(v) if type(v) is float and v.is_integer() else v for v in row[1:]]
+                for row in databuffer]
+        return json.dumps(rows, separators=(',', ':')), sentat - base
+
+
+def _gzip(data):
+    """Return data compressed in the gzip format"""
+
+    # wbits 16 + 15 writes the gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+"""class EmonHubAggregator
+
+Reduces the frames of each node to one per window of time, each value to the
+mean, min, max, last or sum of its values over the window. Only the running
+totals of the current window are kept, whatever the number of frames.
+
+Windows are aligned on multiples of their length, and the aggregate frame is
+timestamped with the start of its window. A frame timestamped up to 'grace'
+seconds before the node's current window is added to it, an older one (eg.
+from a timestamped sender or a replay) is dropped as late: a window is only
+ever aggregated once.
+
+A window is over when a frame of the node falls after its end, or once
+the hub's clock reaches its end as seen from the newest frame: that
+frame's arrival time + (end - its timestamp) + grace. So frames with past
+timestamps (a backlog, a replay, a late clock) are aggregated as live ones.
+
+A node listed in [nodes] sets its own function ('aggregate': a function for
+all its values, a list of functions value by value, or 'off' to keep all
+its frames) and 'window', whether the reporter aggregates frames or not.
+
+"""
+
+
+class EmonHubAggregator(object):
+
+    functions = ['mean', 'min', 'max', 'last', 'sum']
+
+    # Seconds a window stays open after its end, for frames still on their way
+    grace = 2
+
+    def __init__(self, aggregate='mean', window=60, closed=None):
+        """Create an aggregator
+
+        aggregate (string): function of the nodes not listed, 'off' to keep
+            their frames
+        window (int): window of the nodes not listed, in seconds
+        closed (dict): closed attribute of the aggregator replaced, if any
+
+        """
+
+        self._log = logging.getLogger("EmonHub")
+        self.aggregate = aggregate
+        self.window = window
+        # Open windows by node: [start, end, functions, number of frames, values,
+        # newest timestamp, time it is over by the hub's clock]
+        self._windows = {}
+        # Start of the last window aggregated, by node
+        self.closed = closed if closed is not None else {}
+        # Frames dropped, late or not matching their window's number of values
+        self.dropped = 0
+        # Settings by node and number of values, for the nodelist they were read from
+        self._nodelist = None
+        self._node_settings = {}
+
+    def add(self, items):
+        """Aggregate items, [[timestamp, node, val1, val2, ...], ...]
+
+        Return the aggregates of the windows they closed, and the items of the
+        nodes not aggregated.
+
+        """
+
+        closed = []
+        windows = self._windows
+        now = time.time()
+        for item in items:
+            timestamp, node, values = item[0], item[1], item[2:]
+            state = windows.get(node)
+            if state is not None and timestamp >= state[1]:
+                # The current window is over
+                closed.append(self._close(node, windows.pop(node)))
+                state = None
+
+            if state is None:
+                functions, window = self._get_node_settings(node, len(values))
+                if functions is None:
+                    closed.append(item)
+                    continue
+                start = timestamp - timestamp % window
+                if node in self.closed and start <= self.closed[node]:
+                    self._drop(item, "late")
+                    continue
+                # Values that aren't numbers (eg. datacode 'c') keep the last one
+                functions = [function if isinstance(value, (int, long, float)) else 'last'
+                             for function, value in zip(functions, values)]
+                windows[node] = [start, start + window, functions, 1, list(values),
+                                 timestamp, now + start + window - timestamp + self.grace]
+                continue
+
+            if timestamp < state[0] - self.grace:
+                self._drop(item, "late")
+                continue
+            if len(values) != len(state[4]):
+                self._drop(item, "number of values changed")
+                continue
+
+            state[3] += 1
+            if timestamp >= state[5]:
+                state[5] = timestamp
+                state[6] = now + state[1] - timestamp + self.grace
+            totals = state[4]
+            for i, function in enumerate(state[2]):
+                value = values[i]
+                if function in ('mean', 'sum'):
+                    totals[i] += value
+                elif function == 'last':
+                    totals[i] = value
+                elif function == 'min':
+                    if value < totals[i]:
+                        totals[i] = value
+                elif value > totals[i]:
+                    totals[i] = value
+        return closed
+
+    def _drop(self, item, reason):
+        self.dropped += 1
+        self._log.debug("Aggregation dropped frame (" + reason + "): " + str(item))
+
+    def _get_node_settings(self, node, length):
+        """Return the node's functions value by value (None if not aggregated) and window
+
+        Values not listed in the node's settings get the reporter's function,
+        'mean' if the reporter doesn't aggregate frames. The settings are read
+        once for each nodelist set by set_nodelist().
+
+        """
+
+        if ehc.nodelist is not self._nodelist:
+            self._nodelist = ehc.nodelist
+            self._node_settings = {}
+        if (node, length) not in self._node_settings:
+            self._node_settings[node, length] = self._read_node_settings(node, length)
+        return self._node_settings[node, length]
+
+    def _read_node_settings(self, node, length):
+        """Return the node's functions and window as _get_node_settings() does,
+        logging the invalid ones
+
+        """
+
+        settings = self._nodelist.get(str(node), {})
+        default = self.aggregate if self.aggregate != 'off' else 'mean'
+
+        aggregate = settings.get('aggregate', self.aggregate)
+        if isinstance(aggregate, basestring):
+            aggregate = [aggregate] * length
+        functions = [str(function).strip().lower() for function in aggregate][:length]
+        if not functions or 'off' in functions:
+            return None, None
+        functions += [default] * (length - len(functions))
+        for function in sorted(set(functions) - set(self.functions)):
+            self._log.warning("'%s' is not a valid setting for node %s: aggregate" % (function, node))
+        functions = [function if function in self.functions else default for function in functions]
+
+        window = settings.get('window', self.window)
+        if not str(window).isdigit() or not int(window):
+            self._log.warning("'%s' is not a valid setting for node %s: window" % (window, node))
+            window = self.window
+        return functions, int(window)
+
+    def _close(self, node, state):
+        """Return the aggregate frame of a window"""
+
+        start, end, functions, count, totals = state[:5]
+        self.closed[node] = start
+        values = [round(totals[i] / float(count), 3) if function == 'mean' else totals[i]
+                  for i, function in enumerate(functions)]
+        return [start, node] + values
+
+    def expire(self):
+        """Return the aggregates of the windows that are over"""
+
+        now = time.time()
+        closed = []
+        for node, state in self._windows.items():
+            if state[6] <= now:
+                closed.append(self._close(node, self._windows.pop(node)))
+        return closed
+
+    def close(self):
+        """Return the aggregates of all the windows, complete or not"""
+
+        closed = [self._close(node, state) for node, state in self._windows.iteritems()]
+        self._windows.clear()
+        return closed
+
+    def get_timeout(self):
+        """Return the number of seconds until a window is over, None if none open"""
+
+        if not self._windows:
+            return None
+        return max(0, min(state[6] for state in self._windows.itervalues()) - time.time())
+
+"""class EmonHubHTTPConnectionPool
+
+Keeps HTTP/1.1 connections to the servers open between two posts
+
+A reporter posts to the same server over and over again: reusing the
+connection saves the DNS lookup, TCP handshake and TLS negotiation of each
+post. Server addresses are cached for a few minutes and forgotten as soon as
+a connection fails. A request failing on a connection that was kept open
+(the server may have closed it meanwhile) is retried once on a new one.
+
+"""
+
+
+class EmonHubHTTPConnectionPool(object):
+
+    # Idle connections kept per server
+    max_idle = 4
+
+    # Seconds a resolved server address is used for
+    _dns_ttl = 300
+
+    def __init__(self, name):
+
+        self._log = logging.getLogger("EmonHub")
+        self.name = name
+
+        # Idle connections by (scheme, host, port)
+        self._idle = {}
+        # Resolved addresses by (host, port): (address, expiry time)
+        self._addresses = {}
+        self._lock = threading.Lock()
+
+        # Connections opened, requests sent on a kept open connection, requests
+        # retried after a kept open connection failed, name resolutions
+        self._stats = {'opened': 0, 'reused': 0, 'reconnected': 0, 'resolved': 0}
+
+    def request(self, url, body=None, timeout=60, headers=None):
+        """Send a request, POST if there is a body, GET if not
+
+        headers (dict): headers to add to the defaults
+
+        Raise socket.error or httplib.HTTPException if no reply was received.
+
+        Return the reply's status, reason and content
+
+        """
+
+        server, path, headers = self._prepare(url, body, headers)
+
+        conn = self._get(server, timeout)
+        reused = conn is not None
+        if not reused:
+            conn = self._connect(server, timeout)
+        sending = True
+        try:
+            conn.request('GET' if body is None else 'POST', path, body, headers)
+            sending = False
+            response = conn.getresponse()
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+            if not reused:
+                # A new connection failed, the address may have changed
+                self._forget(server)
+                raise
+            if not _closed_before_request(e, sending):
+                # The server may have processed the request, don't send it twice
+                raise
+            self._log.debug(self.name + " connection to " + server[1] + " lost (" +
+                            str(e) + "), reconnecting")
+            self._count('reconnected')
+            conn = self._connect(server, timeout)
+            try:
+                conn.request('GET' if body is None else 'POST', path, body, headers)
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                self._forget(server)
+                raise
+
+        status, reason, data = response.status, response.reason, response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(server, conn)
+        return status, reason, data
+
+    def request_async(self, url, body=None, timeout=60, headers=None):
+        """Send a request as request() does, without blocking
+
+        To be run by an ehl.EmonHubEventLoop task, yields the reply's status,
+        reason and content as an ehl.Return.
+
+        """
+
+        server, path, headers = self._prepare(url, body, headers)
+        deadline = time.time() + timeout
+        method = 'GET' if body is None else 'POST'
+
+        conn = self._get(server, timeout)
+        reused = conn is not None
+        if not reused:
+            conn = self._connect(server, timeout, _AsyncHTTPConnection)
+        try:
+            response = yield conn.request(method, path, body, headers, deadline)
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+            if not reused:
+                self._forget(server)
+                raise
+            if not _closed_before_request(e, conn.sending):
+                # The server may have processed the request, don't send it twice
+                raise
+            self._log.debug(self.name + " connection to " + server[1] + " lost (" +
+                            str(e) + "), reconnecting")
+            self._count('reconnected')
+            conn = self._connect(server, timeout, _AsyncHTTPConnection)
+            try:
+                response = yield conn.request(method, path, body, headers, deadline)
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                self._forget(server)
+                raise
+
+        status, reason, data = response.status, response.reason, response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(server, conn)
+        yield ehl.Return((status, reason, data))
+
+    def _prepare(self, url, body, headers):
+        """Return the server (scheme, host, port), path and headers of a request"""
+
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ['http', 'https'] or not parts.hostname:
+            raise httplib.InvalidURL(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        headers = dict({'User-Agent': 'emonHub'}, **(headers or {}))
+        if body is not None:
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        return (parts.scheme, parts.hostname, port), path, headers
+
+    def _get(self, server, timeout):
+        """Return an idle connection to server, or None"""
+
+        while True:
+            with self._lock:
+                idle = self._idle.get(server)
+                if not idle:
+                    return None
+                conn = idle.pop()
+            if not _is_dropped(conn):
+                break
+            # Closed by the server while idle
+            conn.close()
+        self._count('reused')
+        conn.timeout = timeout
+        if conn.sock and not isinstance(conn, _AsyncHTTPConnection):
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def _put(self, server, conn):
+        """Keep a connection open for the next request to server"""
+
+        with self._lock:
+            idle = self._idle.setdefault(server, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _connect(self, server, timeout, async_class=None):
+        """Return a new connection to server (not connected until used)
+
+        async_class: class of non-blocking connection, None for httplib's
+
+        """
+
+        scheme, host, port = server
+        address = self._resolve(host, port)
+        if async_class is not None:
+            conn = async_class(scheme, host, port, address)
+        elif scheme == 'https':
+            conn = _HTTPSConnection(host, port, address, timeout)
+        else:
+            conn = _HTTPConnection(host, port, address, timeout)
+        self._count('opened')
+        self._log.debug(self.name + " opening connection to " + host + " (" + address + ")")
+        return conn
+
+    def _resolve(self, host, port):
+        """Return the (cached) address of host"""
+
+        now = time.time()
+        with self._lock:
+            cached = self._addresses.get((host, port))
+        if cached and cached[1] > now:
+            return cached[0]
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][0]
+        with self._lock:
+            self._addresses[(host, port)] = (address, now + self._dns_ttl)
+            self._stats['resolved'] += 1
+        return address
+
+    def _forget(self, server):
+        """Forget the address of a server that couldn't be reached"""
+
+        with self._lock:
+            self._addresses.pop(server[1:], None)
+
+    def _count(self, event):
+        with self._lock:
+            self._stats[event] += 1
+
+    def get_stats(self):
+        """Return the number of connections opened, reused and reconnected,
+        and of name resolutions"""
+
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        """Close all the idle connections"""
+
+        with self._lock:
+            idle = [conn for conns in self._idle.itervalues() for conn in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+    """HTTP connection to a host through an address resolved beforehand"""
+
+    def __init__(self, host, port, address, timeout):
+        httplib.HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self._address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self._address, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """HTTPS connection to a host through an address resolved beforehand
+
+    The certificate is still checked against the host name, from Python 2.7.9
+    (ssl.create_default_context): older versions can't check it.
+
+    """
+
+    def __init__(self, host, port, address, timeout):
+        httplib.HTTPSConnection.__init__(self, host, port, timeout=timeout)
+        self._address = address
+
+    def connect(self):
+        sock = socket.create_connection((self._address, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        context = getattr(self, '_context', None)
+        if context is not None:
+            self.sock = context.wrap_socket(sock, server_hostname=self.host)
+        else:
+            # Python < 2.7.9
+            logging.getLogger("EmonHub").warning(
+                "Python " + sys.version.split()[0] + " can't check the certificate of " + self.host +
+                ", upgrade to 2.7.9 or later")
+            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+
+
+"""class _AsyncHTTPConnection
+
+HTTP/1.1 connection sending requests and reading replies without blocking,
+for reporters run by the event loop
+
+The reply is read until it is complete, as told by its headers, then parsed
+by httplib.
+
+"""
+
+
+class _AsyncHTTPConnection(object):
+
+    def __init__(self, scheme, host, port, address):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.timeout = None
+        self.sock = None
+        self._address = address
+        # True until the request has been sent in full
+        self.sending = False
+
+    def request(self, method, path, body, headers, deadline):
+        """Send a request and yield the httplib.HTTPResponse read as an ehl.Return"""
+
+        self.sending = True
+        if self.sock is None:
+            yield self._connect(deadline)
+
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: ' + self.host]
+        lines.extend('%s: %s' % header for header in headers.iteritems())
+        if body is not None:
+            lines.append('Content-Length: ' + str(len(body)))
+        data = '\r\n'.join(lines) + '\r\n\r\n' + (body or '')
+        while data:
+            try:
+                data = data[self.sock.send(data[:65536]):]
+            except ssl.SSLWantWriteError:
+                yield self._wait([], [self.sock], deadline)
+            except socket.error as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                yield self._wait([], [self.sock], deadline)
+        self.sending = False
+
+        data = ''
+        while True:
+            try:
+                chunk = self.sock.recv(65536)
+            except ssl.SSLWantReadError:
+                yield self._wait([self.sock], [], deadline)
+                continue
+            except socket.error as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                yield self._wait([self.sock], [], deadline)
+                continue
+            data += chunk
+            if not chunk or _response_complete(data, method):
+                break
+        if not data:
+            raise httplib.BadStatusLine("''")
+
+        response = httplib.HTTPResponse(_ReplySocket(data), method=method)
+        response.begin()
+        yield ehl.Return(response)
+
+    def _connect(self, deadline):
+        """Connect, and negotiate TLS for https"""
+
+        family = socket.AF_INET6 if ':' in self._address else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = self.sock.connect_ex((self._address, self.port))
+        if err in (errno.EINPROGRESS, errno.EAGAIN):
+            yield self._wait([], [self.sock], deadline)
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+
+        if self.scheme == 'https':
+            # Checked as httplib does
+            context = ssl._create_default_https_context()
+            self.sock = context.wrap_socket(self.sock, server_hostname=self.host,
+                                            do_handshake_on_connect=False)
+            while True:
+                try:
+                    self.sock.do_handshake()
+                    break
+                except ssl.SSLWantReadError:
+                    yield self._wait([self.sock], [], deadline)
+                except ssl.SSLWantWriteError:
+                    yield self._wait([], [self.sock], deadline)
+
+    def _wait(self, read, write, deadline):
+        """Wait for the socket, raise socket.timeout once deadline has passed"""
+
+        now = time.time()
+        if now >= deadline:
+            raise socket.timeout('timed out')
+        yield ehl.Wait(read, write, deadline - now)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def _is_dropped(conn):
+    """Return True if the server closed an idle connection (or sent unexpected data)"""
+
+    if conn.sock is None:
+        return False
+    try:
+        readable = select.select([conn.sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+def _closed_before_request(e, sending):
+    """Return True if error e shows that a kept open connection had been closed
+    by the server before it got the request, which can then be sent again
+
+    That is the case if the server closed the connection without a word
+    (BadStatusLine on an empty reply) or reset it while the request was being
+    sent. Never after a timeout: the server may be processing the request.
+
+    """
+
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, httplib.BadStatusLine):
+        return e.line in ('', "''")
+    return sending and isinstance(e, socket.error) and e.args[0] in (errno.ECONNRESET, errno.EPIPE)
+
+
+def _response_complete(data, method):
+    """Return True if data holds a whole HTTP reply
+
+    A reply with neither a length nor chunks ends when the connection is
+    closed.
+
+    """
+
+    start = 0
+    while True:
+        end = data.find('\r\n\r\n', start)
+        if end < 0:
+            return False
+        lines = data[start:end].split('\r\n')
+        status = lines[0].split(None, 2)
+        headers = dict((name.strip().lower(), value.strip())
+                       for name, sep, value in (line.partition(':') for line in lines[1:]))
+        start = end + 4
+        if len(status) < 2 or not status[1].isdigit():
+            # Let httplib report it
+            return True
+        code = int(status[1])
+        if 100 <= code < 200:
+            # Interim reply, the final one follows
+            continue
+        if method == 'HEAD' or code in (204, 304):
+            return True
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            return _chunks_complete(data, start)
+        if headers.get('content-length', '').isdigit():
+            return len(data) - start >= int(headers['content-length'])
+        return False
+
+
+def _chunks_complete(data, pos):
+    """Return True if data holds all the chunks of a body starting at pos"""
+
+    while True:
+        end = data.find('\r\n', pos)
+        if end < 0:
+            return False
+        try:
+            size = int(data[pos:end].split(';')[0], 16)
+        except ValueError:
+            # Let httplib report it
+            return True
+        if size == 0:
+            # Last chunk, then the trailers up to an empty line
+            return data.find('\r\n\r\n', end) >= 0
+        pos = end + 2 + size + 2
+        if pos > len(data):
+            return False
+
+
+class _ReplySocket(object):
+    """A reply read beforehand, as a socket for httplib.HTTPResponse"""
+
+    def __init__(self, data):
+        self._data = data
+
+    def makefile(self, mode, bufsize=0):
+        return StringIO.StringIO(self._data)
+
+
 """class EmonHubReporterInitError
 
 Raise this when init fails.
@@ -7,10 +7,69 @@
 
 """
 
+import os
 import time
+import errno
+import struct
 import logging
+import ctypes
+import ctypes.util
 from configobj import ConfigObj
 
+# inotify events of a file written in place or replaced by a rename
+# (IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE), and of the watch being lost
+# (IN_Q_OVERFLOW, IN_IGNORED)
+_IN_CHANGED = 0x08 | 0x80 | 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_inotify_event = struct.Struct('iIII')
+
+
+def _inotify_watch(path):
+    """Return a non-blocking inotify fd watching the directory path, or None
+
+    inotify is only available on Linux, other systems poll the file.
+
+    """
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0o2000000))
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path, _IN_CHANGED) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _inotify_read(fd):
+    """Read the pending inotify events
+
+    Return a list of (mask, name) tuples, name is '' for the watched
+    directory itself.
+
+    """
+
+    events = []
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return events
+            raise
+        if not data:
+            return events
+        pos = 0
+        while pos + _inotify_event.size <= len(data):
+            wd, mask, cookie, length = _inotify_event.unpack_from(data, pos)
+            pos += _inotify_event.size
+            events.append((mask, data[pos:pos + length].rstrip('\0')))
+            pos += length
+
 """class EmonHubSetup
 
 User interface to setup the hub.
@@ -36,7 +95,8 @@ The run() method is supposed to be run regularly by the instantiater, to
 perform regular communication tasks.
 
 The check_settings() method is run regularly as well. It checks the settings 
-and returns True is settings were changed.
+and returns True is settings were changed. get_fds() and get_timeout() tell
+when it is next worth calling.
 
 This almost empty class is meant to be inherited by subclasses specific to
 each setup.
@@ -70,6 +130,18 @@ class EmonHubSetup(object):
         To be implemented in child class.
         
         """
+
+    def get_timeout(self):
+        """Return the number of seconds until check_settings() is next due.
+
+        None means the settings don't need to be polled.
+
+        """
+        return None
+
+    def get_fds(self):
+        """Return the file descriptors readable when the settings may have changed."""
+        return []
     
 
 class EmonHubFileSetup(EmonHubSetup):
@@ -81,7 +153,9 @@ class EmonHubFileSetup(EmonHubSetup):
 
         # Initialize update timestamp
         self._settings_update_timestamp = 0
+        self._settings_check_interval = 1
         self._retry_time_interval = 5
+        self._filename = os.path.abspath(filename)
 
         # create a timeout message if time out is set (>0)
         if self._retry_time_interval > 0:
@@ -105,19 +179,44 @@ class EmonHubFileSetup(EmonHubSetup):
             raise EmonHubSetupInitError(
                 'Configuration file error - section: ' + str(e))
 
+        # Watch the directory rather than the file, which editors replace
+        # by renaming a new copy over it. Without inotify, the file's size
+        # and modification time are checked every _settings_check_interval
+        self._file_state = self._stat()
+        self._reload = False
+        self._inotify = _inotify_watch(os.path.dirname(self._filename))
+        if self._inotify is None:
+            self._log.debug("Polling " + self._filename + " for changes")
+
     def check_settings(self):
         """Check settings
         
         Update attribute settings and return True if modified.
+
+        The file is only read again when it was changed, or to retry after
+        an error reading it.
         
         """
-        
-        # Check settings only once per second
+
         now = time.time()
-        if now - self._settings_update_timestamp < 0:
-            return
+        if self._inotify is not None:
+            self._read_events()
+            if not self._reload or now < self._settings_update_timestamp:
+                return
+        else:
+            # Check the file only once per second
+            if now - self._settings_update_timestamp < self._settings_check_interval:
+                return
+            state = self._stat()
+            if state != self._file_state:
+                self._file_state = state
+                self._reload = True
+            if not self._reload:
+                self._settings_update_timestamp = now
+                return
         # Update timestamp
         self._settings_update_timestamp = now
+        self._reload = False
         
         # Backup settings
         settings = dict(self.settings)
@@ -128,17 +227,20 @@ class EmonHubFileSetup(EmonHubSetup):
         except IOError as e:
             self._log.warning('Could not get settings: ' + str(e) + self.retry_msg)
             self._settings_update_timestamp = now + self._retry_time_interval
+            self._reload = True
             return
         except SyntaxError as e:
             self._log.warning('Could not get settings: ' + 
                               'Error parsing config file: ' + str(e) + self.retry_msg)
             self._settings_update_timestamp = now + self._retry_time_interval
+            self._reload = True
             return
         except Exception:
             import traceback
             self._log.warning("Couldn't get settings, Exception: " +
                               traceback.format_exc() + self.retry_msg)
             self._settings_update_timestamp = now + self._retry_time_interval
+            self._reload = True
             return
         
         if self.settings != settings:
@@ -152,6 +254,54 @@ class EmonHubFileSetup(EmonHubSetup):
             else:
                  return True
 
+    def get_timeout(self):
+        """Return the number of seconds until the settings file is next checked"""
+
+        if self._inotify is not None:
+            # Woken up by get_fds() when the file changes, a timeout is
+            # only needed to retry reading it
+            if not self._reload:
+                return None
+            return max(0, self._settings_update_timestamp - time.time())
+        return max(0, self._settings_update_timestamp +
+                   self._settings_check_interval - time.time())
+
+    def get_fds(self):
+        """Return the inotify fd watching the settings file, if any"""
+
+        return [self._inotify] if self._inotify is not None else []
+
+    def _read_events(self):
+        """Flag the file for reloading if an inotify event concerns it"""
+
+        try:
+            events = _inotify_read(self._inotify)
+        except OSError as e:
+            events = [(_IN_IGNORED, '')]
+            self._log.warning("Unable to watch the settings file: " + str(e))
+        name = os.path.basename(self._filename)
+        for mask, filename in events:
+            if filename == name or mask & _IN_Q_OVERFLOW:
+                # Don't wait for a pending retry, this may be the fix
+                self._reload = True
+                self._settings_update_timestamp = 0
+            if mask & _IN_IGNORED:
+                # The directory went away, poll the file from now on
+                os.close(self._inotify)
+                self._inotify = None
+                self._file_state = None
+                self._log.warning("Lost the watch on " + self._filename + ", polling it for changes")
+                return
+
+    def _stat(self):
+        """Return the settings file's identity, size and modification time"""
+
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
 """class EmonHubSetupInitError
 
 Raise this when init fails.